@@ -1,29 +1,44 @@
 import json
 import logging
+import threading
+import time
 import urllib.parse
 import uuid
 from typing import Union
 
 import bottle
-import urllib3
 
 import matrix
+import metrics
+import queues
+import scheduler
+import tracing
 from cache import Cache
+from errors import RequestError
+from matrix_api import MatrixAPI
 from misc import log_except, request
+from pools import Pools
 
 
 class AppService(bottle.Bottle):
-    def __init__(self, config: dict, http: urllib3.PoolManager) -> None:
+    destination = "homeserver"
+
+    def __init__(self, config: dict, pools: Pools, workers=None) -> None:
         super(AppService, self).__init__()
 
         self.as_token = config["as_token"]
         self.hs_token = config["hs_token"]
+        self.metrics_token = config.get("metrics_token") or self.hs_token
         self.base_url = config["homeserver"]
         self.server_name = config["server_name"]
         self.user_id = f"@{config['user_id']}:{self.server_name}"
-        self.http = http
+        self.pools = pools
+        self.http = pools["homeserver"]
         self.logger = logging.getLogger("appservice")
 
+        # Forwards events to worker processes, if enabled.
+        self.workers = workers
+
         # Map events to functions.
         self.mapping = {
             "m.room.member": "on_member",
@@ -37,33 +52,83 @@ class AppService(bottle.Bottle):
             callback=self.receive_event,
             method="PUT",
         )
+        self.route("/metrics", callback=self.metrics, method="GET")
 
-        Cache.cache["m_rooms"] = {}
+        self.m_rooms = Cache("m_rooms", maxsize=10000)  # alias: room_id
 
-    def handle_event(self, event: dict) -> None:
-        event_type = event.get("type")
+        # transaction_id: index of the first event that wasn't handled
+        self.transactions = Cache("transactions", maxsize=1000)
 
-        if event_type in (
-            "m.room.member",
-            "m.room.message",
-            "m.room.redaction",
-        ):
-            obj = matrix.Event(event)
-        else:
-            self.logger.info(f"Unknown event type: {event_type}")
-            return
+        self.transaction_lock = threading.Lock()
+        self.stopping = threading.Event()
 
-        func = getattr(self, self.mapping[event_type], None)
+        # For awaiting many requests at once from a coroutine.
+        self.api = MatrixAPI(
+            self.base_url,
+            self.as_token,
+            int(config.get("max_requests", 10)),
+            self.m_rooms,
+        )
+
+    def handle_event(self, event: dict, received: float = None) -> None:
+        """
+        Bridge an event, `received` is the `time.perf_counter()` at which
+        it's transaction was received.
+        """
 
-        if not func:
-            self.logger.warning(
-                f"Function '{func}' not defined, ignoring event."
+        with tracing.trace("matrix", since=received):
+            tracing.tag(
+                event=event.get("type", ""), room=event.get("room_id", "")
             )
-            return
 
-        # We don't catch exceptions here as the homeserver will re-send us
-        # the event in case of a failure.
-        func(obj)
+            if self.workers:
+                with tracing.span("route"):
+                    routed = self.workers.route_matrix(event)
+
+                if routed:
+                    tracing.hand_off()
+                    return
+
+            event_type = event.get("type")
+
+            if event_type in (
+                "m.room.member",
+                "m.room.message",
+                "m.room.redaction",
+            ):
+                with tracing.span("parse"):
+                    obj = matrix.Event(event)
+            else:
+                self.logger.info(f"Unknown event type: {event_type}")
+                return
+
+            func = getattr(self, self.mapping[event_type], None)
+
+            if not func:
+                self.logger.warning(
+                    f"Function '{func}' not defined, ignoring event."
+                )
+                return
+
+            # We don't catch most exceptions here as the homeserver will
+            # re-send us the event in case of a failure. The homeserver gives
+            # up after a while though, so events are dead-lettered if a
+            # destination is down.
+            try:
+                func(obj)
+            except RequestError as e:
+                if not e.transient:
+                    raise
+
+                self.dead_letter({"source": "matrix", "event": event}, e)
+
+    def dead_letter(self, item: dict, error: Exception) -> None:
+        """
+        Called with the queue item of an event that couldn't be handled as a
+        destination was unavailable.
+        """
+
+        self.logger.warning(f"Dropping event that failed with: {error}")
 
     @log_except
     def receive_event(self, transaction: str) -> dict:
@@ -71,6 +136,7 @@ class AppService(bottle.Bottle):
         Verify the homeserver's token and handle events.
         """
 
+        received = time.perf_counter()
         hs_token = bottle.request.query.getone("access_token")
 
         if not hs_token:
@@ -83,11 +149,59 @@ class AppService(bottle.Bottle):
 
         events = bottle.request.json.get("events")
 
-        for event in events:
-            self.handle_event(event)
+        # Held while handling a transaction, so that shutting down waits for
+        # it to be handled completely.
+        with self.transaction_lock:
+            if self.stopping.is_set():
+                bottle.response.status = 503
+                return {"errcode": "M_UNKNOWN", "error": "Shutting down."}
+
+            # The homeserver re-sends the same transaction if we reject it,
+            # so we continue from the first event that wasn't queued.
+            start = self.transactions.pop(transaction, 0)
+
+            for idx in range(start, len(events)):
+                try:
+                    self.handle_event(events[idx], received)
+                except queues.Full:
+                    self.transactions.set(transaction, idx)
+                    self.logger.warning(
+                        f"Rejecting transaction '{transaction}', the queues "
+                        "are full."
+                    )
+
+                    bottle.response.status = 503
+                    return {
+                        "errcode": "M_UNKNOWN",
+                        "error": "Queues are full.",
+                    }
 
         return {}
 
+    def metrics(self) -> str:
+        """
+        Serve the bridge's metrics in the Prometheus text format, to those
+        that present the metrics token as a bearer token or `access_token`.
+        """
+
+        authorization = bottle.request.get_header("Authorization", "")
+        token = bottle.request.query.getone("access_token")
+
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer ") :]
+
+        if not token:
+            bottle.response.status = 401
+            return {"errcode": "M_MISSING_TOKEN"}
+
+        if token != self.metrics_token:
+            bottle.response.status = 403
+            return {"errcode": "M_FORBIDDEN"}
+
+        bottle.response.content_type = "text/plain; version=0.0.4"
+
+        return metrics.render()
+
     def mxc_url(self, mxc: str) -> str:
         try:
             homeserver, media_id = mxc.replace("mxc://", "").split("/")
@@ -106,6 +220,7 @@ class AppService(bottle.Bottle):
             params={"user_id": mxid} if mxid else {},
         )
 
+    @scheduler.priority(scheduler.EDIT)
     def redact(self, event_id: str, room_id: str, mxid: str = "") -> None:
         self.send(
             "PUT",
@@ -114,8 +229,7 @@ class AppService(bottle.Bottle):
         )
 
     def get_room_id(self, alias: str) -> str:
-        with Cache.lock:
-            room = Cache.cache["m_rooms"].get(alias)
+        room = self.m_rooms.get(alias)
         if room:
             return room
 
@@ -123,8 +237,7 @@ class AppService(bottle.Bottle):
 
         room_id = resp["room_id"]
 
-        with Cache.lock:
-            Cache.cache["m_rooms"][alias] = room_id
+        self.m_rooms.set(alias, room_id)
 
         return room_id
 
@@ -133,12 +246,13 @@ class AppService(bottle.Bottle):
 
         return matrix.Event(resp)
 
+    @scheduler.priority(scheduler.PROFILE)
     def upload(self, url: str) -> str:
         """
         Upload a file to the homeserver and get the MXC url.
         """
 
-        resp = self.http.request("GET", url)
+        resp = self.pools.for_url(url).request("GET", url)
 
         resp = self.send(
             "POST",
@@ -165,6 +279,7 @@ class AppService(bottle.Bottle):
 
         return resp["event_id"]
 
+    @scheduler.priority(scheduler.TYPING)
     def send_typing(
         self, room_id: str, mxid: str = "", timeout: int = 8000
     ) -> None:
@@ -0,0 +1,55 @@
+"""
+Helpers shared by the benchmarks, these run entirely offline.
+"""
+
+import os
+import sys
+import timeit
+from typing import Callable
+
+# The appservice modules aren't a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from pools import Pools  # noqa: E402
+
+SERVER_NAME = "localhost"
+
+
+def make_client(**config) -> main.MatrixClient:
+    """
+    Create a client that doesn't touch the network or the filesystem.
+    """
+
+    return main.MatrixClient(
+        {
+            "as_token": "as_token",
+            "hs_token": "hs_token",
+            "user_id": "appservice-discord",
+            "homeserver": "http://127.0.0.1:8008",
+            "server_name": SERVER_NAME,
+            "discord_token": "discord_token",
+            "port": 5000,
+            "database": "",
+            "database_engine": "memory",
+            **config,
+        },
+        Pools(),
+    )
+
+
+def bench(fn: Callable, number: int = 0, repeat: int = 5) -> float:
+    """
+    Get the best time per call in microseconds.
+    """
+
+    timer = timeit.Timer(fn)
+
+    if not number:
+        number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def report(name: str, *timings: float) -> None:
+    print(f"{name:<40}" + "".join(f"{t:>12.2f}us" for t in timings))
@@ -0,0 +1,113 @@
+"""
+Compare `DiscordClient.process_message` against the previous implementation,
+which did one `str.replace` per mention and channel and ran the emote regex
+twice.
+
+Usage: python3 benchmarks/discord_message.py
+"""
+
+import re
+from typing import Dict, Tuple
+
+import fixtures
+from common import bench, make_client, report
+
+import discord
+
+
+def legacy_process_message(self, message: discord.Message) -> Tuple[str, Dict]:
+    content = message.content
+    emotes = {}
+    regex = r"<a?:(\w+):(\d+)>"
+
+    for member in message.mentions:
+        for char in ("", "!"):
+            content = content.replace(
+                f"<@{char}{member.id}>", f"@{member.username}"
+            )
+
+    channels = re.findall("<#([0-9]+)>", content)
+    if channels:
+        discord_channels = self.get_channels(message.guild_id)
+        for channel in channels:
+            discord_channel = discord_channels.get(channel)
+            name = (
+                discord_channel.name if discord_channel else "deleted-channel"
+            )
+            content = content.replace(f"<#{channel}>", f"#{name}")
+
+    for emote in re.findall(regex, content):
+        emotes[emote[0]] = emote[1]
+
+    content = re.sub(regex, r":\g<1>:", content)
+
+    for attachment in message.attachments:
+        content += f"\n{attachment['url']}"
+
+    for sticker in message.stickers:
+        if sticker.format_type != 3:
+            content += f"\n{discord.CDN_URL}/stickers/{sticker.id}.png"
+
+    return content, emotes
+
+
+def message(content: str, mentions: int = 0, **kwargs) -> discord.Message:
+    return discord.Message(
+        fixtures.discord_message(
+            0,
+            content,
+            mentions=[fixtures.user(i) for i in range(mentions)],
+            **kwargs,
+        )
+    )
+
+
+def corpus() -> dict:
+    return {
+        "plain": message("Just a regular message without anything special."),
+        "mentions": message(
+            " ".join(f"<@{1000 + i}> <@!{1000 + i}> hi" for i in range(50)),
+            mentions=50,
+        ),
+        "channels": message(" ".join(f"<#{i % 10}>" for i in range(50))),
+        "emotes": message(
+            " ".join(
+                f"<:emote{i}:{2000 + i}> <a:anim{i}:9>" for i in range(100)
+            )
+        ),
+        "mixed": message(
+            " ".join(
+                f"<@{1000 + i}> look at <#{i % 10}> <:emote{i}:{2000 + i}>"
+                for i in range(20)
+            ),
+            mentions=20,
+            attachments=[{"url": f"https://cdn/{i}.png"} for i in range(4)],
+        ),
+    }
+
+
+def main() -> None:
+    app = make_client()
+
+    channels = {
+        str(i): discord.Channel(id=str(i), type=0, name=f"channel{i}")
+        for i in range(5)
+    }
+    app.discord.get_channels = lambda guild_id: channels
+
+    print(f"{'case':<40}{'legacy':>14}{'current':>14}")
+
+    for name, msg in corpus().items():
+        assert legacy_process_message(
+            app.discord, msg
+        ) == app.discord.process_message(msg)
+
+        report(
+            name,
+            bench(lambda: legacy_process_message(app.discord, msg)),
+            bench(lambda: app.discord.process_message(msg)),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,420 @@
+"""
+Run the bridge against a fake Discord gateway, API and CDN and a fake
+homeserver, and measure how long it takes to bridge messages in both
+directions. Everything runs locally, the bridge is started as a separate
+process with a temporary configuration and database.
+
+Usage: python3 benchmarks/e2e.py [--messages 500] [--workers 0] [--json FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import aiohttp
+
+from fakes import FakeDiscord, FakeHomeserver, Transactions
+
+# The appservice modules aren't a package.
+APPSERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APPSERVICE_DIR)
+
+import fixtures  # noqa: E402
+from common import SERVER_NAME  # noqa: E402
+from db import DataBase  # noqa: E402
+
+HS_TOKEN = "hs_token"
+CHANNELS = 8
+AUTHORS = 20
+MATRIX_USER = f"@alice:{SERVER_NAME}"
+
+# Seconds to wait for the bridge to start and for a scenario to finish.
+STARTUP_TIMEOUT = 30
+SCENARIO_TIMEOUT = 120
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def channel_id(i: int) -> str:
+    return str(100 + i % CHANNELS)
+
+
+def room_id(i: int) -> str:
+    return f"!room{channel_id(i)}:{SERVER_NAME}"
+
+
+def discord_message(n: int, content: str, **kwargs) -> dict:
+    # Spread over all the channels, sent by a few authors.
+    return fixtures.discord_message(
+        n,
+        content,
+        channel_id=channel_id(n),
+        author=fixtures.user(n % AUTHORS),
+        **kwargs,
+    )
+
+
+def matrix_message(n: int, body: str, **content) -> dict:
+    return fixtures.matrix_event(n, body, room_id=room_id(n), **content)
+
+
+def emotes(n: int, count: int = 20) -> str:
+    return " ".join(fixtures.emote((n + i) % 200) for i in range(count))
+
+
+def guild(members: int, emojis: int) -> dict:
+    return fixtures.guild(
+        members, emojis, [channel_id(i) for i in range(CHANNELS)]
+    )
+
+
+class Harness:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.basedir = tempfile.mkdtemp(prefix="bridge-e2e-")
+        self.bridge_port = free_port()
+        self.bridge: subprocess.Popen = None
+
+        self.next_marker = 0
+        self.sent: Dict[int, float] = {}  # marker: time
+        self.received: Dict[int, float] = {}  # marker: time
+        self.done = asyncio.Event()
+
+        self.transactions = Transactions(
+            f"http://127.0.0.1:{self.bridge_port}", HS_TOKEN
+        )
+        self.discord = FakeDiscord(self.on_message)
+        self.homeserver = FakeHomeserver(
+            self.on_message, SERVER_NAME, self.transactions
+        )
+
+    def on_message(self, marker: int, now: float) -> None:
+        if marker in self.sent and marker not in self.received:
+            self.received[marker] = now
+
+            if len(self.received) == len(self.sent):
+                self.done.set()
+
+    def marker(self) -> int:
+        self.next_marker += 1
+
+        return self.next_marker
+
+    async def start(self) -> None:
+        discord_port, hs_port = free_port(), free_port()
+
+        await self.discord.start(discord_port)
+        await self.homeserver.start(hs_port)
+
+        config = {
+            "as_token": "as_token",
+            "hs_token": HS_TOKEN,
+            "user_id": "appservice-discord",
+            "homeserver": f"http://127.0.0.1:{hs_port}",
+            "server_name": SERVER_NAME,
+            "discord_token": "discord_token",
+            "discord_api": f"{self.discord.url}/api/v8",
+            "discord_cdn": f"{self.discord.url}/cdn",
+            "port": self.bridge_port,
+            "database": f"{self.basedir}/bridge.db",
+            "database_engine": "sqlite",
+            "workers": self.args.workers,
+            "slow_message_log": self.args.slow_log,
+        }
+
+        with open(f"{self.basedir}/appservice.json", "w") as f:
+            json.dump(config, f)
+
+        db = DataBase(config["database"])
+
+        for i in range(CHANNELS):
+            db.add_room(room_id(i), channel_id(i))
+            self.homeserver.join_member(room_id(i), MATRIX_USER, "alice")
+
+        # Bottle's request log would drown out the results.
+        with open(f"{self.basedir}/stdout.log", "w") as stdout:
+            self.bridge = subprocess.Popen(
+                [sys.executable, f"{APPSERVICE_DIR}/main.py", self.basedir],
+                stdout=stdout,
+                stderr=subprocess.STDOUT,
+            )
+
+        await asyncio.wait_for(self.discord.identified.wait(), STARTUP_TIMEOUT)
+
+        # The appservice is started after connecting to the gateway.
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    async with session.get(
+                        f"http://127.0.0.1:{self.bridge_port}/metrics",
+                        headers={"Authorization": f"Bearer {HS_TOKEN}"},
+                    ):
+                        break
+                except aiohttp.ClientError:
+                    if time.monotonic() > deadline:
+                        raise
+
+                    await asyncio.sleep(0.1)
+
+    async def stop(self) -> None:
+        if self.bridge:
+            self.bridge.send_signal(signal.SIGTERM)
+
+            try:
+                self.bridge.wait(STARTUP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.bridge.kill()
+
+        await self.transactions.close()
+        await self.discord.stop()
+        await self.homeserver.stop()
+
+    async def run(self, name: str, send) -> dict:
+        """
+        Run a scenario, `send` is an async generator that sends the messages
+        and yields the marker of every message that will be bridged.
+        """
+
+        self.sent.clear()
+        self.received.clear()
+        self.done.clear()
+
+        start = time.perf_counter()
+
+        async for marker in send():
+            self.sent.setdefault(marker, time.perf_counter())
+
+        try:
+            await asyncio.wait_for(self.done.wait(), SCENARIO_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.result(name, start)
+
+    def result(self, name: str, start: float) -> dict:
+        latencies = sorted(
+            (self.received[marker] - sent) * 1000
+            for marker, sent in self.sent.items()
+            if marker in self.received
+        )
+        elapsed = max(self.received.values(), default=start) - start
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0
+
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+        return {
+            "scenario": name,
+            "sent": len(self.sent),
+            "received": len(self.received),
+            "msgs_per_sec": len(latencies) / elapsed if elapsed else 0,
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99),
+            "max_ms": latencies[-1] if latencies else 0,
+            "mean_ms": statistics.mean(latencies) if latencies else 0,
+        }
+
+    async def discord_messages(self, count: int, content, **kwargs):
+        for _ in range(count):
+            marker = self.marker()
+
+            yield marker
+            await self.discord.dispatch(
+                "MESSAGE_CREATE",
+                discord_message(
+                    marker, f"bench-{marker} {content(marker)}", **kwargs
+                ),
+            )
+
+    async def discord_replies(self, count: int):
+        previous = None
+
+        for _ in range(count):
+            marker = self.marker()
+            message = discord_message(
+                marker,
+                f"bench-{marker} replying",
+                referenced_message=previous,
+            )
+
+            yield marker
+            await self.discord.dispatch("MESSAGE_CREATE", message)
+
+            previous = {**message, "referenced_message": None}
+
+    async def guild_create(self, members: int, emojis: int):
+        await self.discord.dispatch("GUILD_CREATE", guild(members, emojis))
+
+        # Bridged once the guild was handled.
+        async for marker in self.discord_messages(1, lambda n: "after"):
+            yield marker
+
+    async def matrix_messages(self, count: int, body, batch: int = 10):
+        events, markers = [], []
+
+        for n in range(count):
+            marker = self.marker()
+
+            events.append(matrix_message(marker, f"bench-{marker} {body}"))
+            markers.append(marker)
+
+            if len(events) == batch or n == count - 1:
+                for marker in markers:
+                    yield marker
+
+                await self.transactions.push(events)
+                events, markers = [], []
+
+    async def matrix_replies(self, count: int, batch: int = 10):
+        events, markers = [], []
+        previous = None
+
+        for n in range(count):
+            marker = self.marker()
+            body = f"bench-{marker} replying"
+            content = {}
+
+            if previous:
+                body = f"> <{MATRIX_USER}> bench-{previous}\n\n{body}"
+                content = {
+                    "m.relates_to": {
+                        "m.in_reply_to": {"event_id": f"$event{previous}"}
+                    }
+                }
+
+            events.append(matrix_message(marker, body, **content))
+            markers.append(marker)
+            previous = marker
+
+            if len(events) == batch or n == count - 1:
+                for marker in markers:
+                    yield marker
+
+                await self.transactions.push(events)
+                events, markers = [], []
+
+
+def report(results: List[dict]) -> None:
+    columns = ("p50_ms", "p90_ms", "p99_ms", "max_ms", "msgs_per_sec")
+
+    print(
+        f"{'scenario':<24}{'bridged':>12}"
+        + "".join(f"{c:>14}" for c in columns)
+    )
+
+    for result in results:
+        print(
+            f"{result['scenario']:<24}"
+            f"{result['received']:>6}/{result['sent']:<5}"
+            + "".join(f"{result[c]:>14.2f}" for c in columns)
+        )
+
+
+async def run(args: argparse.Namespace) -> List[dict]:
+    harness = Harness(args)
+    count = args.messages
+
+    print(f"Bridge logs are saved to '{harness.basedir}'.")
+
+    try:
+        await harness.start()
+
+        # Register every puppet and create the webhooks beforehand, so that
+        # the first scenario isn't skewed.
+        await harness.run(
+            "warm-up",
+            lambda: harness.discord_messages(
+                max(AUTHORS, CHANNELS), lambda n: "hello"
+            ),
+        )
+        await harness.run(
+            "warm-up", lambda: harness.matrix_messages(CHANNELS, "hello")
+        )
+
+        return [
+            await harness.run(
+                "discord_flood",
+                lambda: harness.discord_messages(
+                    count, lambda n: "a regular message " * 4
+                ),
+            ),
+            await harness.run(
+                "discord_replies", lambda: harness.discord_replies(count)
+            ),
+            await harness.run(
+                "discord_emotes",
+                lambda: harness.discord_messages(count, emotes),
+            ),
+            await harness.run(
+                "guild_create",
+                lambda: harness.guild_create(args.members, 500),
+            ),
+            await harness.run(
+                "matrix_flood",
+                lambda: harness.matrix_messages(
+                    count, "a **regular** message " * 4
+                ),
+            ),
+            await harness.run(
+                "matrix_replies", lambda: harness.matrix_replies(count)
+            ),
+        ]
+    finally:
+        await harness.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=500,
+        help="Messages to send per scenario.",
+    )
+    parser.add_argument(
+        "--members",
+        type=int,
+        default=10000,
+        help="Members in the GUILD_CREATE payload.",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="The bridge's `workers`."
+    )
+    parser.add_argument(
+        "--slow-log",
+        type=float,
+        default=0,
+        help="The bridge's `slow_message_log`.",
+    )
+    parser.add_argument("--json", help="Write the results to a JSON file.")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
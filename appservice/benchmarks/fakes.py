@@ -0,0 +1,326 @@
+"""
+Fake Discord and Matrix servers for the end-to-end benchmark, they implement
+just enough of the APIs for the bridge to work and record when every
+bridged message was received.
+"""
+
+import asyncio
+import base64
+import itertools
+import json
+import re
+import time
+import urllib.parse
+from typing import Callable, Dict
+
+import aiohttp
+from aiohttp import web
+
+# Bridged messages carry a marker so that they can be matched up with the
+# original, replies also contain the marker of the message they quote.
+MARKER_REGEX = re.compile(r"bench-(\d+)")
+
+# A 1x1 transparent PNG, served for every avatar and emote.
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk"
+    "YPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+def marker(text: str) -> int:
+    """
+    Get the marker of a bridged message, the last one wins for replies.
+    """
+
+    markers = MARKER_REGEX.findall(text)
+
+    return int(markers[-1]) if markers else -1
+
+
+class Server:
+    def __init__(self, on_message: Callable[[int, float], None]) -> None:
+        self.on_message = on_message
+        self.app = web.Application(client_max_size=64 * 1024**2)
+        self.runner: web.AppRunner = None
+        self.ids = itertools.count(1)
+
+    async def start(self, port: int) -> None:
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+    def received(self, text: str) -> None:
+        self.on_message(marker(text), time.perf_counter())
+
+
+class FakeDiscord(Server):
+    """
+    Discord's gateway, REST API and CDN. Dispatch events are sent to the
+    bridge with `dispatch()`, messages sent through webhooks are recorded.
+    """
+
+    def __init__(self, on_message: Callable[[int, float], None]) -> None:
+        super().__init__(on_message)
+
+        self.url = ""
+        self.websocket: web.WebSocketResponse = None
+        self.identified = asyncio.Event()
+        self.seq = 0
+        self.webhooks: Dict[str, dict] = {}  # channel_id: webhook
+
+        self.app.add_routes(
+            [
+                web.get("/", self.gateway),
+                web.get("/api/v8/gateway", self.gateway_url),
+                web.get(
+                    "/api/v8/channels/{channel}/webhooks", self.get_webhooks
+                ),
+                web.post(
+                    "/api/v8/channels/{channel}/webhooks", self.create_webhook
+                ),
+                web.post("/api/v8/webhooks/{id}/{token}", self.send_webhook),
+                web.get("/cdn/{path:.*}", self.cdn),
+                web.route("*", "/api/v8/{path:.*}", self.empty),
+            ]
+        )
+
+    async def start(self, port: int) -> None:
+        self.url = f"http://127.0.0.1:{port}"
+
+        await super().start(port)
+
+    async def gateway_url(self, request: web.Request) -> web.Response:
+        return web.json_response({"url": f"ws://127.0.0.1:{request.url.port}"})
+
+    async def gateway(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse(max_msg_size=0)
+        await websocket.prepare(request)
+
+        await websocket.send_json(
+            {
+                "op": 10,
+                "d": {"heartbeat_interval": 41250},
+                "s": None,
+                "t": None,
+            }
+        )
+
+        async for message in websocket:
+            data = json.loads(message.data)
+
+            if data["op"] in (2, 6):  # IDENTIFY, RESUME
+                self.websocket = websocket
+
+                await self.dispatch("READY", {"session_id": "benchmark"})
+                self.identified.set()
+            elif data["op"] == 1:  # HEARTBEAT
+                await websocket.send_json(
+                    {"op": 11, "d": None, "s": None, "t": None}
+                )
+
+        return websocket
+
+    async def dispatch(self, otype: str, data: dict) -> None:
+        self.seq += 1
+
+        await self.websocket.send_str(
+            json.dumps({"op": 0, "d": data, "s": self.seq, "t": otype})
+        )
+
+    async def get_webhooks(self, request: web.Request) -> web.Response:
+        webhook = self.webhooks.get(request.match_info["channel"])
+
+        return web.json_response([webhook] if webhook else [])
+
+    async def create_webhook(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        webhook = {
+            "id": str(next(self.ids)),
+            "token": "token",
+            "name": body["name"],
+        }
+
+        self.webhooks[request.match_info["channel"]] = webhook
+
+        return web.json_response(webhook)
+
+    async def send_webhook(self, request: web.Request) -> web.Response:
+        body = await request.json()
+
+        self.received(body["content"])
+
+        return web.json_response(
+            {
+                "id": str(next(self.ids)),
+                "channel_id": "0",
+                "content": body["content"],
+                "webhook_id": request.match_info["id"],
+                "author": {
+                    "id": request.match_info["id"],
+                    "username": body["username"],
+                    "discriminator": "0000",
+                    "avatar": None,
+                },
+            }
+        )
+
+    async def cdn(self, request: web.Request) -> web.Response:
+        return web.Response(body=PNG, content_type="image/png")
+
+    async def empty(self, request: web.Request) -> web.Response:
+        return web.json_response([] if request.method == "GET" else {})
+
+
+class FakeHomeserver(Server):
+    """
+    The homeserver's client-server API, messages sent to rooms are recorded.
+    Membership changes are pushed to the bridge like a homeserver would, so
+    that it's member cache is invalidated.
+    """
+
+    def __init__(
+        self,
+        on_message: Callable[[int, float], None],
+        server_name: str,
+        transactions: "Transactions",
+    ) -> None:
+        super().__init__(on_message)
+
+        self.server_name = server_name
+        self.transactions = transactions
+        self.members: Dict[str, Dict[str, dict]] = {}  # room_id: members
+        self.events: Dict[str, dict] = {}  # event_id: event
+        self.tasks = set()
+
+        prefix = "/_matrix/client/r0"
+
+        self.app.add_routes(
+            [
+                web.post(f"{prefix}/register", self.register),
+                web.get(
+                    f"{prefix}/rooms/{{room}}/joined_members",
+                    self.joined_members,
+                ),
+                web.post(f"{prefix}/join/{{room}}", self.join),
+                web.put(
+                    f"{prefix}/rooms/{{room}}/send/{{type}}/{{txn}}",
+                    self.send,
+                ),
+                web.get(
+                    f"{prefix}/rooms/{{room}}/event/{{event}}", self.get_event
+                ),
+                web.post("/_matrix/media/r0/upload", self.upload),
+                web.route("*", f"{prefix}/{{path:.*}}", self.empty),
+            ]
+        )
+
+    def join_member(self, room_id: str, mxid: str, name: str = "") -> None:
+        self.members.setdefault(room_id, {})[mxid] = {
+            "avatar_url": None,
+            "display_name": name,
+        }
+
+    async def register(self, request: web.Request) -> web.Response:
+        body = await request.json()
+
+        return web.json_response(
+            {"user_id": f"@{body['username']}:{self.server_name}"}
+        )
+
+    async def joined_members(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"joined": self.members.get(request.match_info["room"], {})}
+        )
+
+    async def join(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room"]
+        mxid = request.query["user_id"]
+
+        self.join_member(room_id, mxid)
+
+        # Kept around until it's done, the event loop only has a weak
+        # reference to it.
+        task = asyncio.ensure_future(self.push_member(room_id, mxid))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return web.json_response({"room_id": room_id})
+
+    async def push_member(self, room_id: str, mxid: str) -> None:
+        event = {
+            "type": "m.room.member",
+            "event_id": f"${next(self.ids)}",
+            "room_id": room_id,
+            "sender": mxid,
+            "state_key": mxid,
+            "content": {"membership": "join"},
+        }
+
+        await self.transactions.push([event])
+
+    async def send(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        event_id = f"${next(self.ids)}"
+
+        self.events[event_id] = {
+            "type": request.match_info["type"],
+            "event_id": event_id,
+            "room_id": request.match_info["room"],
+            "sender": request.query.get("user_id", ""),
+            "content": body,
+        }
+
+        if "m.new_content" not in body:
+            self.received(body.get("body", ""))
+
+        return web.json_response({"event_id": event_id})
+
+    async def get_event(self, request: web.Request) -> web.Response:
+        event = self.events.get(request.match_info["event"])
+
+        if not event:
+            return web.json_response({"errcode": "M_NOT_FOUND"}, status=404)
+
+        return web.json_response(event)
+
+    async def upload(self, request: web.Request) -> web.Response:
+        await request.read()
+
+        return web.json_response(
+            {"content_uri": f"mxc://{self.server_name}/{next(self.ids)}"}
+        )
+
+    async def empty(self, request: web.Request) -> web.Response:
+        return web.json_response({})
+
+
+class Transactions:
+    """
+    Send transactions to the bridge, like the homeserver does.
+    """
+
+    def __init__(self, bridge_url: str, hs_token: str) -> None:
+        self.bridge_url = bridge_url
+        self.params = urllib.parse.urlencode({"access_token": hs_token})
+        self.ids = itertools.count(1)
+        self.session: aiohttp.ClientSession = None
+
+    async def push(self, events: list) -> None:
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+        txn = next(self.ids)
+
+        async with self.session.put(
+            f"{self.bridge_url}/transactions/{txn}?{self.params}",
+            json={"events": events},
+        ) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"Transaction {txn} failed: {resp.status}")
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
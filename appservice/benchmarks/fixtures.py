@@ -0,0 +1,253 @@
+"""
+Fixture corpora for the benchmarks, modelled on the traffic of busy bridged
+channels. Everything is generated deterministically so that runs can be
+compared with each other.
+"""
+
+from typing import Dict, Iterable, List
+
+from common import SERVER_NAME
+
+import discord
+import main
+import matrix
+
+GUILD_ID = "3"
+CHANNEL_ID = "2"
+ROOM_ID = f"!room:{SERVER_NAME}"
+USERS = 50
+EMOTES = 500
+CHANNELS = 50
+
+SENTENCES = (
+    "did anyone else get the update yet?",
+    "**finally** fixed it, the config was wrong the whole time",
+    "lol no",
+    "check the pinned messages, it's explained there",
+    "`pip install -e .` and then run it again",
+    "||spoilers|| for the finale, don't read this",
+    "> quoting the docs\nwhich say the opposite",
+    "https://example.com/some/long/link?with=query&params=1",
+    "__underlined__ and ~~struck~~ and *italic* text",
+    "```py\nprint('hello world')\n```",
+)
+
+
+def user(i: int) -> dict:
+    return {
+        "id": str(1000 + i),
+        "username": f"user{i}",
+        "discriminator": f"{i % 10000:04}",
+        "avatar": f"a_{i:032x}" if i % 3 == 0 else None,
+    }
+
+
+def mxid(i: int) -> str:
+    return f"@_discord_{1000 + i}:{SERVER_NAME}"
+
+
+def text(i: int, sentences: int = 3) -> str:
+    return " ".join(
+        SENTENCES[(i + j) % len(SENTENCES)] for j in range(sentences)
+    )
+
+
+def emote(i: int) -> str:
+    return f"<{'a' if i % 5 == 0 else ''}:emote{i}:{2000 + i}>"
+
+
+def discord_message(i: int, content: str, **kwargs) -> dict:
+    return {
+        "id": str(10**6 + i),
+        "channel_id": CHANNEL_ID,
+        "guild_id": GUILD_ID,
+        "content": content,
+        "author": user(i % USERS),
+        "mentions": [],
+        "attachments": [],
+        "timestamp": "2021-06-01T12:00:00.000000+00:00",
+        "tts": False,
+        "mention_everyone": False,
+        "pinned": False,
+        "type": 0,
+        **kwargs,
+    }
+
+
+def discord_messages() -> Dict[str, dict]:
+    mentioned = [user(i) for i in range(10)]
+
+    return {
+        "plain": discord_message(0, "lol no"),
+        "chat": discord_message(1, text(1)),
+        "mentions": discord_message(
+            2,
+            " ".join(
+                f"<@!{u['id']}> {text(i, 1)}" for i, u in enumerate(mentioned)
+            ),
+            mentions=mentioned,
+        ),
+        "channels": discord_message(
+            3, " ".join(f"see <#{i}>" for i in range(20))
+        ),
+        "emotes": discord_message(
+            4, " ".join(f"{emote(i)} {emote(i + 1)}" for i in range(30))
+        ),
+        "reply": discord_message(
+            5,
+            text(5, 2),
+            referenced_message=discord_message(4, text(4, 2)),
+            message_reference={
+                "message_id": str(10**6 + 4),
+                "channel_id": CHANNEL_ID,
+                "guild_id": GUILD_ID,
+            },
+        ),
+        "attachments": discord_message(
+            6,
+            text(6, 1),
+            attachments=[
+                {
+                    "id": str(i),
+                    "filename": f"image{i}.png",
+                    "url": f"{discord.CDN_URL}/attachments/2/{i}/image.png",
+                }
+                for i in range(4)
+            ],
+            sticker_items=[{"name": "wave", "id": "9", "format_type": 1}],
+        ),
+        "long": discord_message(
+            7,
+            (
+                text(7, 10)
+                + " "
+                + " ".join(emote(i) for i in range(20))
+                + f" <@{mentioned[0]['id']}> <#1>"
+            )[: discord.MESSAGE_LIMIT],
+            mentions=mentioned[:1],
+        ),
+    }
+
+
+def guild(
+    members: int, emojis: int = EMOTES, channels: Iterable[str] = None
+) -> dict:
+    if channels is None:
+        channels = [str(i) for i in range(CHANNELS)]
+
+    return {
+        "id": GUILD_ID,
+        "name": "guild",
+        "channels": [
+            {"id": channel, "type": 0, "name": f"channel{i}", "position": i}
+            for i, channel in enumerate(channels)
+        ],
+        "emojis": [
+            {
+                "id": str(2000 + i),
+                "name": f"emote{i}",
+                "animated": i % 5 == 0,
+                "roles": [],
+                "require_colons": True,
+            }
+            for i in range(emojis)
+        ],
+        "members": [
+            {
+                "user": user(i),
+                "nick": None,
+                "roles": [],
+                "joined_at": "2021-06-01T12:00:00.000000+00:00",
+            }
+            for i in range(members)
+        ],
+    }
+
+
+def matrix_event(i: int, body: str, room_id: str = ROOM_ID, **content) -> dict:
+    return {
+        "type": "m.room.message",
+        "event_id": f"$event{i}",
+        "room_id": room_id,
+        "sender": f"@alice:{SERVER_NAME}",
+        "origin_server_ts": 1622548800000 + i,
+        "unsigned": {"age": 100},
+        "content": {"msgtype": "m.text", "body": body, **content},
+    }
+
+
+def pill(i: int) -> str:
+    return f'<a href="https://matrix.to/#/{mxid(i)}">user{i}#{i:04}</a>'
+
+
+def matrix_events() -> Dict[str, dict]:
+    return {
+        "plain": matrix_event(0, "lol no"),
+        "chat": matrix_event(1, text(1)),
+        "emotes": matrix_event(
+            2, " ".join(f"word :emote{i % 50}:" for i in range(60))
+        ),
+        "mentions": matrix_event(
+            3,
+            " ".join(f"user{i}#{i:04}: {text(i, 1)}" for i in range(10)),
+            format="org.matrix.custom.html",
+            formatted_body=" ".join(
+                f"{pill(i)}: {text(i, 1)}" for i in range(10)
+            ),
+        ),
+        "reply": matrix_event(
+            4,
+            f"> <{mxid(1)}> {text(2, 1)}\n\n{text(4, 2)}",
+            format="org.matrix.custom.html",
+            formatted_body=(
+                f"<mx-reply><blockquote>{pill(1)}<br />{text(2, 1)}"
+                f"</blockquote></mx-reply>{text(4, 2)}"
+            ),
+            **{"m.relates_to": {"m.in_reply_to": {"event_id": "$event2"}}},
+        ),
+        "edit": matrix_event(
+            5,
+            f" * {text(5, 2)}",
+            **{
+                "m.new_content": {"msgtype": "m.text", "body": text(5, 2)},
+                "m.relates_to": {"rel_type": "m.replace", "event_id": "$e"},
+            },
+        ),
+    }
+
+
+def usernames() -> List[str]:
+    return [f"user{i}" for i in range(USERS)] + [
+        "Some Webhook With A Long Name",
+        "名前",
+    ]
+
+
+def populate(app: main.MatrixClient) -> None:
+    """
+    Fill the client's caches and database like a bridge that has been
+    running for a while, so that nothing is fetched from the network.
+    """
+
+    app.db.add_room(ROOM_ID, CHANNEL_ID)
+
+    for i in range(USERS):
+        app.db.add_user(mxid(i))
+        app.db.add_username(f"user{i}#{i:04}", mxid(i))
+
+    for i in range(EMOTES):
+        app.discord.d_emotes.set(f"emote{i}", emote(i))
+        app.m_emotes.set(f"emote{i}", f"mxc://{SERVER_NAME}/emote{i}")
+
+    # The target of the replies.
+    app.d_messages.set(str(10**6 + 4), "$event4")
+    app.m_events.set(
+        "$event4",
+        main.strip_reply(matrix.Event(matrix_event(4, text(4, 2)))),
+    )
+
+    channels = {
+        str(i): discord.Channel(id=str(i), type=0, name=f"channel{i}")
+        for i in range(CHANNELS)
+    }
+    app.discord.get_channels = lambda guild_id: channels
@@ -0,0 +1,113 @@
+"""
+Compare `MatrixClient.process_message` against the previous implementation,
+which did one `str.replace` per emote and mention.
+
+Usage: python3 benchmarks/matrix_message.py
+"""
+
+import re
+import urllib.parse
+
+import fixtures
+from common import bench, make_client, report
+
+import discord
+import matrix
+
+
+def legacy_process_message(self, event: matrix.Event) -> str:
+    message = event.new_body if event.new_body else event.body
+
+    emotes = re.findall(r":(\w*):", message)
+
+    mentions = list(
+        re.finditer(
+            self.mention_regex(encode=False, id_as_group=True),
+            event.formatted_body,
+        )
+    )
+    mentions.extend(
+        re.finditer(
+            self.mention_regex(encode=True, id_as_group=True),
+            event.formatted_body,
+        )
+    )
+
+    for emote in set(emotes):
+        emote_ = self.discord.d_emotes.get(emote)
+        if emote_:
+            message = message.replace(f":{emote}:", emote_)
+
+    for mention in set(mentions):
+        username = self.db.fetch_user(
+            urllib.parse.unquote(mention.group(0))
+        ).get("username")
+        if username:
+            if mention.group(2):
+                message = message.replace(mention.group(0), f"@{username}")
+            else:
+                for replace in (mention.group(0), username):
+                    message = message.replace(
+                        replace, f"<@{mention.group(1)}>"
+                    )
+
+    return message[: discord.MESSAGE_LIMIT]
+
+
+def event(body: str, formatted_body: str = "") -> matrix.Event:
+    return matrix.Event(
+        fixtures.matrix_event(0, body, formatted_body=formatted_body)
+    )
+
+
+def corpus(app) -> dict:
+    users = []
+
+    for i in range(20):
+        mxid = fixtures.mxid(i)
+        app.db.add_user(mxid)
+        app.db.add_username(f"user{i}#{i:04}", mxid)
+        users.append(mxid)
+
+    for i in range(500):
+        app.discord.d_emotes.set(f"emote{i}", f"<:emote{i}:{2000 + i}>")
+
+    pills = " ".join(
+        f'<a href="https://matrix.to/#/{mxid}">user{i}#{i:04}</a>'
+        for i, mxid in enumerate(users)
+    )
+
+    return {
+        "plain": event("Just a regular message without anything special."),
+        "emotes": event(" ".join(f"word :emote{i % 50}:" for i in range(100))),
+        "distinct_emotes": event(" ".join(f":emote{i}:" for i in range(500))),
+        "mentions": event(
+            " ".join(f"user{i}#{i:04}: hi" for i in range(20)), pills
+        ),
+        "mixed": event(
+            " ".join(
+                f"user{i}#{i:04} :emote{i}: :unknown{i}:" for i in range(20)
+            ),
+            pills,
+        ),
+    }
+
+
+def main() -> None:
+    app = make_client()
+    events = corpus(app)
+
+    print(f"{'case':<40}{'legacy':>14}{'current':>14}")
+
+    for name, ev in events.items():
+        assert legacy_process_message(app, ev) == app.process_message(ev)
+
+        report(
+            name,
+            bench(lambda: legacy_process_message(app, ev)),
+            bench(lambda: app.process_message(ev)),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Micro-benchmarks for the message conversion hot paths, results can be saved
+as JSON and compared against a previous run to catch regressions.
+
+Usage:
+    python3 benchmarks/suite.py --json before.json
+    python3 benchmarks/suite.py --compare before.json [--threshold 10]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from typing import Callable, Dict
+
+import fixtures
+from common import bench, make_client
+
+import discord
+import matrix
+from misc import hash_str
+
+# Bumped when the cases change in a way that makes old results meaningless.
+FORMAT_VERSION = 1
+
+
+def cases() -> Dict[str, Callable[[], object]]:
+    app = make_client()
+    fixtures.populate(app)
+
+    messages = {
+        name: discord.Message(payload)
+        for name, payload in fixtures.discord_messages().items()
+    }
+    events = {
+        name: matrix.Event(payload)
+        for name, payload in fixtures.matrix_events().items()
+    }
+    small_guild, large_guild = fixtures.guild(100), fixtures.guild(10000)
+
+    result = {}
+
+    for name, payload in fixtures.discord_messages().items():
+        result[f"discord.Message/{name}"] = lambda p=payload: discord.Message(
+            p
+        )
+
+    result["discord.Guild/100_members"] = lambda: discord.Guild(small_guild)
+    result["discord.Guild/10000_members"] = lambda: discord.Guild(large_guild)
+
+    for name, payload in fixtures.matrix_events().items():
+        result[f"matrix.Event/{name}"] = lambda p=payload: matrix.Event(p)
+
+    for name, message in messages.items():
+        result[f"DiscordClient.process_message/{name}"] = (
+            lambda m=message: app.discord.process_message(m)
+        )
+
+    for name, event in events.items():
+        result[f"MatrixClient.process_message/{name}"] = (
+            lambda e=event: app.process_message(e)
+        )
+
+    # The converted messages are what's formatted for Matrix.
+    for name in ("chat", "emotes", "long"):
+        content, emotes = app.discord.process_message(messages[name])
+
+        result[f"get_fmt/{name}"] = lambda c=content, e=emotes: app.get_fmt(
+            c, e
+        )
+        result[f"create_message_event/{name}"] = (
+            lambda c=content, e=emotes: app.create_message_event(c, e)
+        )
+
+    content, emotes = app.discord.process_message(messages["reply"])
+    reference = messages["reply"].referenced_message
+
+    result["create_message_event/reply"] = lambda: app.create_message_event(
+        content, emotes, reference=reference
+    )
+    result["create_message_event/edit"] = lambda: app.create_message_event(
+        content, emotes, edit="$event4"
+    )
+
+    result["mention_regex"] = lambda: app.mention_regex(
+        encode=True, id_as_group=True
+    )
+
+    usernames = fixtures.usernames()
+
+    result[f"hash_str/{len(usernames)}_usernames"] = lambda: [
+        hash_str(username) for username in usernames
+    ]
+
+    return result
+
+
+def run(pattern: str, repeat: int) -> Dict[str, float]:
+    results = {}
+
+    for name, fn in cases().items():
+        if pattern in name:
+            results[name] = bench(fn, repeat=repeat)
+            print(f"{name:<50}{results[name]:>12.2f}us", flush=True)
+
+    return results
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> int:
+    """
+    Print the change against a previous run, returns the number of cases
+    that got slower by more than `threshold` percent.
+    """
+
+    regressions = 0
+
+    print(f"\n{'case':<50}{'before':>14}{'after':>14}{'change':>10}")
+
+    for name, after in results.items():
+        before = baseline.get(name)
+
+        if before is None:
+            print(f"{name:<50}{'-':>14}{after:>12.2f}us{'new':>10}")
+            continue
+
+        change = (after - before) / before * 100
+        flag = ""
+
+        if change > threshold:
+            regressions += 1
+            flag = "  <- slower"
+
+        print(
+            f"{name:<50}{before:>12.2f}us{after:>12.2f}us{change:>+9.1f}%"
+            f"{flag}"
+        )
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--json", help="Write the results to a JSON file.")
+    parser.add_argument(
+        "--compare", help="Compare against the results in a JSON file."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10,
+        help="Percentage after which a slowdown counts as a regression.",
+    )
+    parser.add_argument(
+        "--filter", default="", help="Only run the cases containing this."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per case, the best wins."
+    )
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "timestamp": int(time.time()),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "unit": "us",
+                    "results": results,
+                },
+                f,
+                indent=4,
+            )
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+        if baseline.get("version") != FORMAT_VERSION:
+            sys.exit(f"'{args.compare}' is from an incompatible version.")
+
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
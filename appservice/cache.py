@@ -1,6 +1,226 @@
+import heapq
 import threading
+import time
+from collections import OrderedDict
+from itertools import count, islice
+from typing import Any, Dict, List, Optional
 
 
 class Cache:
-    cache = {}
-    lock = threading.Lock()
+    """
+    A named, thread-safe cache with an optional size bound and expiry.
+
+    `maxsize` is the maximum number of entries, `ttl` is the number of seconds
+    after which an entry expires and `lru` decides whether the least recently
+    used or the oldest entry is evicted once the cache is full. A value of `0`
+    disables the respective limit.
+    """
+
+    # All the caches by name, for reporting.
+    caches: Dict[str, "Cache"] = {}
+
+    def __init__(
+        self, name: str, maxsize: int = 0, ttl: float = 0, lru: bool = True
+    ) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lru = lru
+
+        # Every cache has it's own lock so that they don't contend
+        # with each other.
+        self.lock = threading.Lock()
+        self.data: OrderedDict = OrderedDict()  # key: (value, timestamp)
+
+        # Reads reorder LRU caches, so their expiry order is kept separately
+        # as a heap of (timestamp, n, key). Items of removed or replaced
+        # entries are skipped lazily, and dropped once they make up half of
+        # it so that caches that are never compacted don't grow it forever.
+        self.expiry: List[tuple] = []
+        self.counter = count()
+
+        self.hits = self.misses = self.evictions = 0
+
+        Cache.caches[name] = self
+
+    def __contains__(self, key: Any) -> bool:
+        return self.peek(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def expired(self, timestamp: float, now: float) -> bool:
+        return bool(self.ttl) and now - timestamp > self.ttl
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.data.get(key)
+
+            if entry is None or self.expired(entry[1], time.monotonic()):
+                self.misses += 1
+                return default
+
+            self.hits += 1
+
+            if self.lru:
+                self.data.move_to_end(key)
+
+        return entry[0]
+
+    def peek(self, key: Any, default: Any = None) -> Any:
+        """
+        Get a value without affecting the stats or the eviction order.
+        """
+
+        with self.lock:
+            entry = self.data.get(key)
+
+        if entry is None or self.expired(entry[1], time.monotonic()):
+            return default
+
+        return entry[0]
+
+    def set(self, key: Any, value: Any) -> None:
+        with self.lock:
+            self.insert(key, value)
+
+    def values(self) -> List[Any]:
+        with self.lock:
+            return [value for value, _ in self.data.values()]
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        with self.lock:
+            value = self.remove(key)
+
+        return default if value is None else value
+
+    def clear(self) -> None:
+        with self.lock:
+            for key in list(self.data):
+                self.remove(key)
+
+            self.expiry.clear()
+
+    def insert(self, key: Any, value: Any) -> None:
+        """
+        Add or replace an entry, the caller must hold `self.lock`.
+        """
+
+        self.remove(key)
+
+        timestamp = time.monotonic()
+        self.data[key] = (value, timestamp)
+
+        if self.ttl and self.lru:
+            heapq.heappush(self.expiry, (timestamp, next(self.counter), key))
+
+        if self.maxsize and len(self.data) > self.maxsize:
+            self.remove(next(iter(self.data)))
+            self.evictions += 1
+
+        if len(self.expiry) > 2 * len(self.data):
+            self.expiry = [
+                (timestamp, next(self.counter), key)
+                for key, (_, timestamp) in self.data.items()
+            ]
+            heapq.heapify(self.expiry)
+
+    def remove(self, key: Any) -> Optional[Any]:
+        """
+        Remove an entry and return it's value, the caller must hold
+        `self.lock`.
+        """
+
+        entry = self.data.pop(key, None)
+
+        return entry[0] if entry else None
+
+    def compact(self, budget: int = 500) -> int:
+        """
+        Look at most at `budget` of the oldest entries, remove the expired
+        ones and return the number of removed entries. The lock is only held
+        for a single batch.
+        """
+
+        if not self.ttl:
+            return 0
+
+        removed = 0
+        now = time.monotonic()
+
+        with self.lock:
+            if not self.lru:
+                entries = list(islice(self.data.items(), budget))
+
+                for key, (_, timestamp) in entries:
+                    if not self.expired(timestamp, now):
+                        # Entries are in insertion order, the rest are newer.
+                        break
+
+                    self.remove(key)
+                    removed += 1
+
+                return removed
+
+            while budget and self.expiry:
+                timestamp, _, key = self.expiry[0]
+
+                if not self.expired(timestamp, now):
+                    break
+
+                heapq.heappop(self.expiry)
+                budget -= 1
+                entry = self.data.get(key)
+
+                # The key was removed or set again since.
+                if entry and entry[1] == timestamp:
+                    self.remove(key)
+                    removed += 1
+
+        return removed
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class MessageMap(Cache):
+    """
+    Map message IDs between Matrix and Discord, forgetting mappings that are
+    older than `max_age` seconds or beyond the `max_count` most recent ones.
+    """
+
+    def __init__(self, name: str, max_age: float = 0, max_count: int = 0):
+        super().__init__(name, maxsize=max_count, ttl=max_age, lru=False)
+
+        self.reverse = {}  # value: key
+
+    def find(self, value: str) -> Optional[str]:
+        """
+        Get the key that maps to a given value.
+        """
+
+        with self.lock:
+            key = self.reverse.get(value)
+
+        return key if key and self.peek(key) else None
+
+    def insert(self, key: str, value: str) -> None:
+        # Under the same lock as the forward map, so that `find()` never
+        # sees one without the other.
+        super().insert(key, value)
+
+        self.reverse[value] = key
+
+    def remove(self, key: str) -> Optional[str]:
+        value = super().remove(key)
+
+        if value is not None and self.reverse.get(value) == key:
+            del self.reverse[value]
+
+        return value
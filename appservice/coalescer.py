@@ -0,0 +1,105 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+import metrics
+
+
+class Coalescer:
+    """
+    Hold calls for the same key for `window` seconds, only the latest call
+    is made once nothing new was submitted within the window. A window of
+    `0` makes the calls immediately.
+    """
+
+    def __init__(self, name: str, window: float = 0) -> None:
+        self.name = name
+        self.window = window
+        self.logger = logging.getLogger(name)
+
+        self.lock = threading.Lock()
+        self.pending: Dict[Hashable, Tuple[threading.Timer, Callable]] = {}
+        self.running: Dict[Hashable, threading.Event] = {}
+
+        # Number of calls that were superseded or cancelled.
+        self.saved = 0
+
+    def submit(self, key: Hashable, fn: Callable[[], Any]) -> None:
+        """
+        Schedule `fn` for `key`, replacing any call that is still pending.
+        """
+
+        if not self.window:
+            fn()
+            return
+
+        timer = threading.Timer(self.window, self.run, (key,))
+        timer.daemon = True
+
+        with self.lock:
+            previous = self.pending.get(key)
+
+            if previous:
+                previous[0].cancel()
+                self.count_saved()
+
+            self.pending[key] = (timer, fn)
+
+        timer.start()
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Drop the pending call for `key` and wait for it to finish if it's
+        already being made, so that whatever follows it isn't reordered.
+        """
+
+        with self.lock:
+            pending = self.pending.pop(key, None)
+            running = self.running.get(key)
+
+            if pending:
+                pending[0].cancel()
+                self.count_saved()
+
+        if running:
+            running.wait()
+
+        return pending is not None
+
+    def flush(self) -> int:
+        """
+        Make all the pending calls now, returns the number of calls made.
+        """
+
+        with self.lock:
+            keys = list(self.pending)
+
+        for key in keys:
+            self.run(key)
+
+        return len(keys)
+
+    def run(self, key: Hashable) -> None:
+        with self.lock:
+            pending = self.pending.pop(key, None)
+
+            if not pending:
+                return
+
+            pending[0].cancel()
+            done = self.running[key] = threading.Event()
+
+        try:
+            pending[1]()
+        except Exception:
+            self.logger.exception(f"Exception in coalesced call for {key}:")
+        finally:
+            with self.lock:
+                if self.running.get(key) is done:
+                    del self.running[key]
+
+            done.set()
+
+    def count_saved(self) -> None:
+        self.saved += 1
+        metrics.COALESCED_CALLS.inc(coalescer=self.name)
@@ -1,120 +1,229 @@
-import os
-import sqlite3
 import threading
-from typing import List
+from typing import Dict, List
 
+from cache import Cache
+from storage import ENGINES
 
-class DataBase:
-    def __init__(self, db_file) -> None:
-        self.create(db_file)
-
-        # The database is accessed via multiple threads.
-        self.lock = threading.Lock()
-
-    def create(self, db_file) -> None:
-        """
-        Create a database with the relevant tables if it doesn't already exist.
-        """
 
-        exists = os.path.exists(db_file)
-
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.conn.row_factory = self.dict_factory
-
-        self.cur = self.conn.cursor()
-
-        if exists:
-            return
-
-        self.cur.execute(
-            "CREATE TABLE bridge(room_id TEXT PRIMARY KEY, channel_id TEXT);"
+class DataBase:
+    def __init__(
+        self,
+        db_file: str,
+        profile_cache_size: int = 4096,
+        engine: str = "sqlite",
+        profile_ttl: float = 0,
+    ) -> None:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown database engine '{engine}'.")
+
+        self.storage = ENGINES[engine](db_file)
+
+        # LRU cache of user profiles, `{}` is cached for unknown users too
+        # so that repeated lookups for them don't hit the database either.
+        self.profiles = Cache(
+            "profiles", maxsize=profile_cache_size, ttl=profile_ttl
         )
 
-        self.cur.execute(
-            "CREATE TABLE users(mxid TEXT PRIMARY KEY, "
-            "avatar_url TEXT, username TEXT);"
-        )
+        # Bumped on every write under `self.lock`, so that a profile read
+        # from the database concurrently with a write doesn't get cached.
+        self.lock = threading.Lock()
+        self.generation = 0
 
-        self.conn.commit()
+        self.load_rooms()
 
-    def dict_factory(self, cursor, row):
+    def load_rooms(self) -> None:
         """
-        https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.row_factory
+        Load the bridged rooms from the database, they're looked up for every
+        message in both directions so they're always kept in memory.
         """
 
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+        channels = self.storage.list_rooms()  # room_id: channel_id
+
+        with self.lock:
+            self.channels = channels
+            self.rooms = {v: k for k, v in channels.items()}  # channel: room
 
     def add_room(self, room_id: str, channel_id: str) -> None:
         """
         Add a bridged room to the database.
         """
 
+        self.storage.add_room(room_id, channel_id)
+
         with self.lock:
-            self.cur.execute(
-                "INSERT INTO bridge (room_id, channel_id) VALUES (?, ?)",
-                [room_id, channel_id],
-            )
-            self.conn.commit()
+            self.channels[room_id] = channel_id
+            self.rooms[channel_id] = room_id
 
     def add_user(self, mxid: str) -> None:
-        with self.lock:
-            self.cur.execute("INSERT INTO users (mxid) VALUES (?)", [mxid])
-            self.conn.commit()
+        self.storage.add_user(mxid)
 
-    def add_avatar(self, avatar_url: str, mxid: str) -> None:
         with self.lock:
-            self.cur.execute(
-                "UPDATE users SET avatar_url = (?) WHERE mxid = (?)",
-                [avatar_url, mxid],
+            self.generation += 1
+            self.profiles.set(
+                mxid, {"mxid": mxid, "avatar_url": None, "username": None}
             )
-            self.conn.commit()
+
+    def add_avatar(self, avatar_url: str, mxid: str) -> None:
+        self.storage.update_user(mxid, "avatar_url", avatar_url)
+
+        self.update_profile(mxid, "avatar_url", avatar_url)
 
     def add_username(self, username: str, mxid: str) -> None:
+        self.storage.update_user(mxid, "username", username)
+
+        self.update_profile(mxid, "username", username)
+
+    def update_profile(self, mxid: str, key: str, value: str) -> None:
+        """
+        Write-through a changed profile field, dropping the entry if it isn't
+        a complete cached profile.
+        """
+
         with self.lock:
-            self.cur.execute(
-                "UPDATE users SET username = (?) WHERE mxid = (?)",
-                [username, mxid],
-            )
-            self.conn.commit()
+            self.generation += 1
+
+            profile = self.profiles.peek(mxid)
+
+            if profile:
+                profile[key] = value
+            else:
+                self.profiles.pop(mxid)
 
     def get_channel(self, room_id: str) -> str:
         """
         Get the corresponding channel ID for a given room ID.
         """
 
-        with self.lock:
-            self.cur.execute(
-                "SELECT channel_id FROM bridge WHERE room_id = ?", [room_id]
-            )
+        # Return an empty string if the channel is not bridged.
+        return self.channels.get(room_id, "")
 
-            room = self.cur.fetchone()
+    def get_room(self, channel_id: str) -> str:
+        """
+        Get the corresponding room ID for a given channel ID.
+        """
 
         # Return an empty string if the channel is not bridged.
-        return "" if not room else room["channel_id"]
+        return self.rooms.get(channel_id, "")
 
     def list_channels(self) -> List[str]:
         """
         Get a list of all the bridged channels.
         """
 
+        return list(self.rooms)
+
+    def fetch_user(self, mxid: str) -> dict:
+        """
+        Fetch the profile for a bridged user.
+        """
+
         with self.lock:
-            self.cur.execute("SELECT channel_id FROM bridge")
+            user = self.profiles.get(mxid)
 
-            channels = self.cur.fetchall()
+            if user is not None:
+                # Return a copy so that callers can't modify the cache.
+                return dict(user)
 
-        return [channel["channel_id"] for channel in channels]
+            generation = self.generation
 
-    def fetch_user(self, mxid: str) -> dict:
+        user = self.storage.fetch_user(mxid)
+
+        with self.lock:
+            if generation == self.generation:
+                self.profiles.set(mxid, dict(user))
+
+        return user
+
+    def add_webhook(
+        self, channel_id: str, webhook_id: str, token: str
+    ) -> None:
         """
-        Fetch the profile for a bridged user.
+        Save the webhook used for a channel, replacing the previous one.
+        """
+
+        self.storage.add_webhook(channel_id, webhook_id, token)
+
+    def list_webhooks(self) -> Dict[str, dict]:
+        """
+        Get the saved webhooks for all channels.
+        """
+
+        return self.storage.list_webhooks()
+
+    def add_emote(self, name: str, mxc_url: str) -> None:
+        """
+        Save the MXC url of an emote that was uploaded to the homeserver.
+        """
+
+        self.storage.add_emote(name, mxc_url)
+
+    def list_emotes(self) -> Dict[str, str]:
+        return self.storage.list_emotes()
+
+    def touch_room(self, room_id: str, timestamp: int) -> None:
+        """
+        Record the last time that a message was bridged in a room.
+        """
+
+        self.storage.touch_room(room_id, timestamp)
+
+    def list_active_rooms(self, limit: int) -> List[str]:
         """
+        Get the `limit` most recently active bridged rooms.
+        """
+
+        return self.storage.list_active_rooms(limit)
+
+    def warm_profiles(self) -> int:
+        """
+        Fill the profile cache from the database, returns the number of
+        cached profiles.
+        """
+
+        users = list(self.fetch_users().items())
+
+        with self.lock:
+            self.generation += 1
+
+            # The most recent entries are kept if the cache is too small.
+            for mxid, user in users[-self.profiles.maxsize :]:
+                self.profiles.set(mxid, user)
+
+        return len(self.profiles)
+
+    def fetch_users(self, mxids: List[str] = None) -> Dict[str, dict]:
+        """
+        Fetch the profiles for all bridged users in a single query, or the
+        profiles for `mxids` with the cached ones skipping the database.
+        Unknown users are mapped to `{}` like `fetch_user`.
+        """
+
+        if mxids is None:
+            return self.storage.fetch_users()
+
+        users, missing = {}, []
+
+        with self.lock:
+            for mxid in mxids:
+                user = self.profiles.get(mxid)
+
+                if user is None:
+                    missing.append(mxid)
+                else:
+                    users[mxid] = dict(user)
+
+            generation = self.generation
+
+        if not missing:
+            return users
+
+        fetched = self.storage.fetch_users(missing)
 
         with self.lock:
-            self.cur.execute("SELECT * FROM users where mxid = ?", [mxid])
+            for mxid in missing:
+                user = users[mxid] = fetched.get(mxid, {})
 
-            user = self.cur.fetchone()
+                if generation == self.generation:
+                    self.profiles.set(mxid, dict(user))
 
-        return {} if not user else user
+        return users
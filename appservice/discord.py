@@ -2,6 +2,7 @@ from dataclasses import dataclass
 
 from misc import dict_cls
 
+API_URL = "https://discord.com/api/v8"
 CDN_URL = "https://cdn.discordapp.com"
 MESSAGE_LIMIT = 2000
 
@@ -1,5 +1,19 @@
 class RequestError(Exception):
+    # Set if the request failed before reaching the destination.
+    unsent = False
+    # Seconds to wait before retrying a rate limited request.
+    retry_after = 0.0
+
     def __init__(self, status: int, *args):
         super().__init__(*args)
 
         self.status = status
+
+    @property
+    def transient(self) -> bool:
+        """
+        Whether the request may succeed later, the destination is either
+        unreachable, overloaded or rate limiting us.
+        """
+
+        return self.status is None or self.status == 429 or self.status >= 500
@@ -0,0 +1,130 @@
+import functools
+import html
+import re
+from typing import List
+
+# Messages without any of these characters are rendered as-is.
+MARKUP_REGEX = re.compile(r"[*_~|`>\\\n<&]")
+
+# Only short messages are cached as they're the ones likely to be repeated.
+CACHE_LIMIT = 256
+
+CODE_BLOCK_REGEX = re.compile(r"```(?:([\w+#.-]+)\n)?\n?(.*?)```", re.DOTALL)
+INLINE_CODE_REGEX = re.compile(r"(`+)(.+?)\1", re.DOTALL)
+ESCAPE_REGEX = re.compile(r"\\([*_~|`>\\])")
+PLACEHOLDER_REGEX = re.compile("\x00([0-9]+)\x00")
+
+# Applied in order, the content has already been HTML escaped.
+INLINE_RULES = (
+    (
+        re.compile(r"\*\*\*(?!\s)(.+?)(?<!\s)\*\*\*"),
+        r"<strong><em>\1</em></strong>",
+    ),
+    (re.compile(r"\*\*(?!\s)(.+?)(?<!\s)\*\*"), r"<strong>\1</strong>"),
+    (re.compile(r"(?<!\w)__(?!\s)(.+?)(?<!\s)__(?!\w)"), r"<u>\1</u>"),
+    (re.compile(r"\*(?![\s*])(.+?)(?<![\s*])\*"), r"<em>\1</em>"),
+    (re.compile(r"(?<!\w)_(?![\s_])(.+?)(?<![\s_])_(?!\w)"), r"<em>\1</em>"),
+    (re.compile(r"~~(?!\s)(.+?)(?<!\s)~~"), r"<del>\1</del>"),
+    (re.compile(r"\|\|(.+?)\|\|"), r"<span data-mx-spoiler>\1</span>"),
+)
+
+
+def render(message: str) -> str:
+    """
+    Render Discord flavoured markdown to Matrix HTML, messages without any
+    markup are returned unchanged.
+    """
+
+    if not MARKUP_REGEX.search(message):
+        return message
+
+    if len(message) <= CACHE_LIMIT:
+        return render_cached(message)
+
+    return render_markup(message)
+
+
+@functools.lru_cache(maxsize=4096)
+def render_cached(message: str) -> str:
+    return render_markup(message)
+
+
+def render_markup(message: str) -> str:
+    # Code and escaped characters must not be formatted, so they're replaced
+    # with placeholders and restored at the end.
+    placeholders: List[str] = []
+
+    def placeholder(rendered: str) -> str:
+        placeholders.append(rendered)
+
+        return f"\x00{len(placeholders) - 1}\x00"
+
+    def code_block(match: re.Match) -> str:
+        lang, code = match.groups()
+        attr = f' class="language-{html.escape(lang)}"' if lang else ""
+
+        return placeholder(
+            f"<pre><code{attr}>{html.escape(code, quote=False)}</code></pre>"
+        )
+
+    def inline_code(match: re.Match) -> str:
+        code = match.group(2).strip()
+
+        return placeholder(f"<code>{html.escape(code, quote=False)}</code>")
+
+    # Placeholders use NUL bytes, which can't be present in a message.
+    message = message.replace("\x00", "")
+    message = CODE_BLOCK_REGEX.sub(code_block, message)
+    message = INLINE_CODE_REGEX.sub(inline_code, message)
+    message = ESCAPE_REGEX.sub(
+        lambda match: placeholder(html.escape(match.group(1))), message
+    )
+
+    message = html.escape(message, quote=False)
+
+    for regex, replacement in INLINE_RULES:
+        message = regex.sub(replacement, message)
+
+    message = render_quotes(message)
+
+    return PLACEHOLDER_REGEX.sub(
+        lambda match: placeholders[int(match.group(1))], message
+    )
+
+
+def blockquote(lines: List[str]) -> str:
+    return f"<blockquote>{'<br />'.join(lines)}</blockquote>"
+
+
+def render_quotes(message: str) -> str:
+    """
+    Wrap lines starting with "> " in blockquotes, ">>> " quotes the rest of
+    the message. Other newlines are converted to line breaks.
+    """
+
+    lines = message.split("\n")
+    rendered = ""
+    quote: List[str] = []
+
+    for idx, line in enumerate(lines):
+        if line.startswith("&gt;&gt;&gt; "):
+            quote.extend([line[13:], *lines[idx + 1 :]])
+            break
+
+        if line.startswith("&gt; "):
+            quote.append(line[5:])
+            continue
+
+        # Blockquotes already break the line.
+        if quote:
+            rendered += blockquote(quote)
+            quote = []
+        elif idx:
+            rendered += "<br />"
+
+        rendered += line
+
+    if quote:
+        rendered += blockquote(quote)
+
+    return rendered
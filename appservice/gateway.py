@@ -1,44 +1,111 @@
 import asyncio
 import json
 import logging
+import os
+import signal
+import time
 import urllib.parse
 from typing import Dict, List
 
-import urllib3
 import websockets
 
 import discord
+import metrics
+import queues
+import scheduler
+import tracing
+from errors import RequestError
 from misc import dict_cls, log_except, request
+from pools import Pools
 
 
 class Gateway:
-    def __init__(self, http: urllib3.PoolManager, token: str):
-        self.http = http
+    destination = "discord"
+
+    def __init__(self, pools: Pools, token: str, workers=None):
+        self.http = pools["discord"]
         self.token = token
         self.logger = logging.getLogger("discord")
         self.Payloads = discord.Payloads(self.token)
         self.websocket = None
+        self.heartbeat_sent = 0.0
+
+        # Forwards events to worker processes, if enabled.
+        self.workers = workers
+
+        self.resume = False
+        self.stopping = False
 
     @log_except
     async def run(self) -> None:
         self.heartbeat_task: asyncio.Future = None
-        self.resume = False
+
+        # Stop after handling the current event on SIGINT or SIGTERM.
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
 
         gateway_url = self.get_gateway_url()
 
-        while True:
+        while not self.stopping:
             try:
                 await self.gateway_handler(gateway_url)
             except (
                 websockets.ConnectionClosedError,
                 websockets.InvalidMessage,
             ):
-                self.logger.exception("Connection lost, reconnecting.")
+                if not self.stopping:
+                    self.logger.exception("Connection lost, reconnecting.")
 
             # Stop sending heartbeats until we reconnect.
             if self.heartbeat_task and not self.heartbeat_task.cancelled():
                 self.heartbeat_task.cancel()
 
+    def stop(self) -> None:
+        """
+        Disconnect from the gateway, the session can be resumed later.
+        """
+
+        self.logger.info("Disconnecting from the gateway.")
+
+        self.stopping = True
+
+        # Closing with a 1000 code would invalidate the session.
+        if self.websocket:
+            asyncio.ensure_future(self.websocket.close(code=4000))
+
+    def save_session(self, path: str) -> None:
+        """
+        Save the session, so that the events which are sent while we're
+        restarting can be received by resuming it.
+        """
+
+        if not self.Payloads.session:
+            return
+
+        with open(path, "w") as f:
+            json.dump(
+                {"session": self.Payloads.session, "seq": self.Payloads.seq}, f
+            )
+
+    def load_session(self, path: str) -> None:
+        """
+        Resume the saved session on the next connection, the gateway tells
+        us to identify again if it has expired.
+        """
+
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r") as f:
+            session = json.load(f)
+
+        os.remove(path)
+
+        self.Payloads.session = session["session"]
+        self.Payloads.seq = session["seq"]
+        self.resume = True
+
     def get_gateway_url(self) -> str:
         resp = self.send("GET", "/gateway")
 
@@ -48,8 +115,9 @@ class Gateway:
         while True:
             await asyncio.sleep(interval_ms / 1000)
             await self.websocket.send(json.dumps(self.Payloads.HEARTBEAT()))
+            self.heartbeat_sent = time.perf_counter()
 
-    async def handle_resp(self, data: dict) -> None:
+    async def handle_resp(self, data: dict, received: float = None) -> None:
         data_dict = data["d"]
 
         opcode = data["op"]
@@ -57,6 +125,11 @@ class Gateway:
         seq = data["s"]
 
         if seq:
+            # Sequence numbers are consecutive, unless we missed something.
+            if self.Payloads.seq and seq > self.Payloads.seq + 1:
+                metrics.GATEWAY_SEQ_GAPS.inc(seq - self.Payloads.seq - 1)
+
+            metrics.GATEWAY_SEQ.set(seq)
             self.Payloads.seq = seq
 
         if opcode == discord.GatewayOpCodes.DISPATCH:
@@ -67,7 +140,13 @@ class Gateway:
 
                 self.logger.info("READY")
             else:
-                self.handle_otype(data_dict, otype)
+                # Handled in a thread, so that waiting for space in the
+                # workers' queues or backing off from retries doesn't stop
+                # us from sending heartbeats.
+                with tracing.trace("discord", since=received):
+                    await asyncio.to_thread(
+                        self.handle_otype, data_dict, otype
+                    )
         elif opcode == discord.GatewayOpCodes.HELLO:
             heartbeat_interval = data_dict.get("heartbeat_interval")
 
@@ -96,26 +175,53 @@ class Gateway:
             self.resume = False
             await self.websocket.close()
         elif opcode == discord.GatewayOpCodes.HEARTBEAT_ACK:
-            # NOP
-            pass
+            if self.heartbeat_sent:
+                metrics.GATEWAY_HEARTBEAT.set(
+                    time.perf_counter() - self.heartbeat_sent
+                )
         else:
             self.logger.info(
                 "Unknown OP code: {opcode}\n{json.dumps(data, indent=4)}"
             )
 
     def handle_otype(self, data: dict, otype: str) -> None:
-        if otype in ("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE"):
-            obj = discord.Message(data)
-        elif otype == "TYPING_START":
-            obj = dict_cls(data, discord.Typing)
-        elif otype == "GUILD_CREATE":
-            obj = discord.Guild(data)
-        elif otype == "GUILD_MEMBER_UPDATE":
-            obj = discord.GuildMemberUpdate(data)
-        elif otype == "GUILD_EMOJIS_UPDATE":
-            obj = discord.GuildEmojisUpdate(data)
-        else:
-            return
+        tracing.tag(event=otype, channel=data.get("channel_id", ""))
+
+        if self.workers:
+            try:
+                with tracing.span("route"):
+                    routed = self.workers.route_discord(data, otype)
+            except queues.Full as e:
+                # Retried later as the gateway won't send it again.
+                self.dead_letter(
+                    {"source": "discord", "type": otype, "data": data}, e
+                )
+                return
+
+            if routed:
+                tracing.hand_off()
+                metrics.GATEWAY_EVENTS.inc(type=otype)
+                return
+
+        with tracing.span("parse"):
+            if otype in (
+                "MESSAGE_CREATE",
+                "MESSAGE_UPDATE",
+                "MESSAGE_DELETE",
+            ):
+                obj = discord.Message(data)
+            elif otype == "TYPING_START":
+                obj = dict_cls(data, discord.Typing)
+            elif otype == "GUILD_CREATE":
+                obj = discord.Guild(data)
+            elif otype == "GUILD_MEMBER_UPDATE":
+                obj = discord.GuildMemberUpdate(data)
+            elif otype == "GUILD_EMOJIS_UPDATE":
+                obj = discord.GuildEmojisUpdate(data)
+            else:
+                return
+
+        metrics.GATEWAY_EVENTS.inc(type=otype)
 
         func = getattr(self, f"on_{otype.lower()}", None)
 
@@ -126,10 +232,30 @@ class Gateway:
             return
 
         try:
-            func(obj)
+            with metrics.GATEWAY_DISPATCH.time(type=otype):
+                func(obj)
+        except RequestError as e:
+            if not e.transient:
+                self.logger.exception(
+                    f"Ignoring exception in '{func.__name__}':"
+                )
+                return
+
+            # Retried later as the gateway won't send it again.
+            self.dead_letter(
+                {"source": "discord", "type": otype, "data": data}, e
+            )
         except Exception:
             self.logger.exception(f"Ignoring exception in '{func.__name__}':")
 
+    def dead_letter(self, item: dict, error: Exception) -> None:
+        """
+        Called with the queue item of an event that couldn't be handled as a
+        destination was unavailable.
+        """
+
+        self.logger.warning(f"Dropping event that failed with: {error}")
+
     async def gateway_handler(self, gateway_url: str) -> None:
         async with websockets.connect(
             f"{gateway_url}/?v=8&encoding=json"
@@ -137,7 +263,9 @@ class Gateway:
             self.websocket = websocket
 
             async for message in websocket:
-                await self.handle_resp(json.loads(message))
+                received = time.perf_counter()
+
+                await self.handle_resp(json.loads(message), received)
 
     def get_channel(self, channel_id: str) -> discord.Channel:
         """
@@ -191,6 +319,7 @@ class Gateway:
 
         return dict_cls(resp, discord.Webhook)
 
+    @scheduler.priority(scheduler.EDIT)
     def edit_webhook(
         self, content: str, message_id: str, webhook: discord.Webhook
     ) -> None:
@@ -201,6 +330,7 @@ class Gateway:
             {"content": content},
         )
 
+    @scheduler.priority(scheduler.EDIT)
     def delete_webhook(
         self, message_id: str, webhook: discord.Webhook
     ) -> None:
@@ -244,8 +374,7 @@ class Gateway:
         self, method: str, path: str, content: dict = {}, params: dict = {}
     ) -> dict:
         endpoint = (
-            f"https://discord.com/api/v8{path}?"
-            f"{urllib.parse.urlencode(params)}"
+            f"{discord.API_URL}{path}?" f"{urllib.parse.urlencode(params)}"
         )
         headers = {
             "Authorization": f"Bot {self.token}",
@@ -0,0 +1,50 @@
+import glob
+import json
+import os
+import threading
+from typing import List
+
+
+class Journal:
+    """
+    Append-only file of queue items that couldn't be handled before shutting
+    down, one JSON object per line. They're replayed on the next start.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def append(self, item: dict) -> None:
+        line = json.dumps(item, separators=(",", ":"))
+
+        with self.lock, open(self.path, "a") as f:
+            f.write(f"{line}\n")
+
+
+def load(basedir: str) -> List[dict]:
+    """
+    Read and remove all the journals in a directory, a partially written
+    last line is skipped.
+    """
+
+    items = []
+
+    for path in sorted(glob.glob(f"{basedir}/journal*.jsonl")):
+        items.extend(read(path))
+        os.remove(path)
+
+    return items
+
+
+def read(path: str) -> List[dict]:
+    items = []
+
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    return items
@@ -1,38 +1,162 @@
 import asyncio
+import copy
+import functools
 import json
 import logging
 import os
+import queue
 import re
 import sys
 import threading
+import time
 import urllib.parse
-from typing import Dict, List, Tuple
-
-import markdown
-import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
 
 import discord
+import formatting
+import journal
 import matrix
+import resilience
+import scheduler
+import tracing
 from appservice import AppService
-from cache import Cache
+from cache import Cache, MessageMap
+from coalescer import Coalescer
 from db import DataBase
 from errors import RequestError
 from gateway import Gateway
 from misc import dict_cls, except_deleted, hash_str
+from pools import DEFAULTS as POOL_DEFAULTS
+from pools import Pools
+from queues import BoundedQueue
+from resilience import DeadLetters
+from workers import Router, dispatch
+
+# Mentions can either be in the form of `<@1234>` or `<@!1234>`, channels
+# are `<#1234>` and emotes are `<:name:1234>` or `<a:name:1234>`.
+TOKEN_REGEX = re.compile(r"<(?:@!?([0-9]+)|#([0-9]+)|a?:(\w+):([0-9]+))>")
+
+# Profile syncs for more users than this load all the puppets' profiles.
+SYNC_LOOKUP_LIMIT = 100
+
+
+@functools.lru_cache(maxsize=256)
+def substitution_regex(literals: Tuple[str, ...], pattern: str) -> re.Pattern:
+    """
+    Compile a regex matching any of the literals or the given pattern, this is
+    cached as the same set of users tends to be mentioned repeatedly.
+    """
+
+    # Try longer literals first in-case one is a prefix of another.
+    literals = sorted(literals, key=len, reverse=True)
+
+    return re.compile("|".join(map(re.escape, literals)) + f"|{pattern}")
+
+
+def strip_reply(event: matrix.Event) -> matrix.Event:
+    """
+    Get a copy of an event with the reply fallbacks stripped from it's
+    content, for quoting it in a reply.
+    """
+
+    event = copy.copy(event)
+
+    tmp = ""
+    # We don't want to strip lines starting with "> " after
+    # encountering a regular line, so we use this variable.
+    got_fallback = True
+    for line in event.body.split("\n"):
+        if not line.startswith("> "):
+            got_fallback = False
+        if not got_fallback:
+            tmp += line
+
+    event.body = tmp
+    event.formatted_body = (
+        # re.DOTALL allows the match to span newlines.
+        re.sub(
+            "<mx-reply.+?</mx-reply>",
+            "",
+            event.formatted_body,
+            flags=re.DOTALL,
+        )
+        if event.formatted_body
+        else event.body
+    )
 
+    return event
 
-class MatrixClient(AppService):
-    def __init__(self, config: dict, http: urllib3.PoolManager) -> None:
-        super().__init__(config, http)
 
-        self.db = DataBase(config["database"])
-        self.discord = DiscordClient(self, config, http)
+class MatrixClient(AppService):
+    def __init__(
+        self,
+        config: dict,
+        pools: Pools,
+        workers: Router = None,
+    ) -> None:
+        super().__init__(config, pools, workers)
+
+        self.db = DataBase(
+            config["database"],
+            engine=config.get("database_engine", "sqlite"),
+            # Profiles are synced by the ingress process when using workers,
+            # so they're only cached for a short while.
+            profile_ttl=60 if int(config.get("workers", 0)) else 0,
+        )
+        self.discord = DiscordClient(self, config, pools)
         self.format = "_discord_"  # "{@,#}_discord_1234:localhost"
         self.id_regex = "[0-9]+"  # Snowflakes may have variable length
 
-        # TODO Find a cleaner way to use these keys.
-        for k in ("m_emotes", "m_members", "m_messages"):
-            Cache.cache[k] = {}
+        self.emote_regex = re.compile(r":(?P<emote>\w*):")
+        self.mention_regexes = (
+            re.compile(self.mention_regex(encode=False, id_as_group=True)),
+            # For clients that properly encode mentions.
+            # 'https://matrix.to/#/%40_discord_...%3Adomain.tld'
+            re.compile(self.mention_regex(encode=True, id_as_group=True)),
+        )
+
+        self.m_emotes = Cache("m_emotes", maxsize=10000)  # name: mxc_url
+        self.m_members = Cache("m_members", maxsize=1000)  # room_id: members
+
+        # Number of recently active rooms to fetch the members for on startup.
+        self.prefetch_members = int(config.get("prefetch_members", 50))
+        self.active = {}  # room_id: last time the activity was saved
+
+        # Only a unique set of emotes is uploaded at a time.
+        self.emote_lock = threading.Lock()
+
+        # Old messages are rarely edited or replied to, so we don't need to
+        # keep their mappings around forever.
+        self.message_retention = int(config.get("message_retention", 604800))
+        self.message_limit = int(config.get("message_limit", 100000))
+
+        # event_id: message_id
+        self.m_messages = MessageMap(
+            "m_messages", self.message_retention, self.message_limit
+        )
+        # message_id: event_id
+        self.d_messages = MessageMap(
+            "d_messages", self.message_retention, self.message_limit
+        )
+
+        # Recently bridged events with their reply fallbacks stripped, so
+        # that replying to them doesn't require fetching them again.
+        self.m_events = Cache(  # event_id: matrix.Event
+            "m_events",
+            maxsize=int(config.get("reply_cache_size", 10000)),
+            ttl=self.message_retention,
+            lru=False,
+        )
+
+        # Rapid successive edits to a message are sent only once.
+        self.edits = Coalescer("edits", float(config.get("edit_window", 0)))
+
+        # Events that failed while a destination was down, replayed later.
+        self.dead_letters = DeadLetters(self.logger)
+
+    def dead_letter(self, item: dict, error: Exception) -> None:
+        self.dead_letters.add(item, error)
 
     def handle_bridge(self, message: matrix.Event) -> None:
         # Ignore events that aren't for us.
@@ -66,14 +190,12 @@ class MatrixClient(AppService):
         self.create_room(channel, message.sender)
 
     def on_member(self, event: matrix.Event) -> None:
-        with Cache.lock:
-            # Just lazily clear the whole member cache on
-            # membership update events.
-            if event.room_id in Cache.cache["m_members"]:
-                self.logger.info(
-                    f"Clearing member cache for room '{event.room_id}'."
-                )
-                del Cache.cache["m_members"][event.room_id]
+        # Just lazily clear the whole member cache on
+        # membership update events.
+        if self.m_members.pop(event.room_id):
+            self.logger.info(
+                f"Clearing member cache for room '{event.room_id}'."
+            )
 
         if (
             event.sender.split(":")[-1] != self.server_name
@@ -96,51 +218,84 @@ class MatrixClient(AppService):
         # Handle bridging commands.
         self.handle_bridge(message)
 
-        channel_id = self.db.get_channel(message.room_id)
+        with tracing.span("lookup"):
+            channel_id = self.db.get_channel(message.room_id)
 
         if not channel_id:
             return
 
-        author = self.get_members(message.room_id)[message.sender]
+        tracing.tag(channel=channel_id)
 
-        webhook = self.discord.get_webhook(
-            channel_id, self.discord.webhook_name
-        )
+        self.touch_room(message.room_id)
+
+        with tracing.span("members"):
+            author = self.get_members(message.room_id)[message.sender]
+
+        with tracing.span("webhook"):
+            webhook = self.discord.get_webhook(
+                channel_id, self.discord.webhook_name
+            )
 
         if message.relates_to and message.reltype == "m.replace":
-            with Cache.lock:
-                message_id = Cache.cache["m_messages"].get(message.relates_to)
+            message_id = self.m_messages.get(message.relates_to)
 
             # TODO validate if the original author sent the edit.
 
             if not message_id or not message.new_body:
                 return
 
-            message.new_body = self.process_message(message)
+            @scheduler.priority(scheduler.EDIT)
+            def edit() -> None:
+                message.new_body = self.process_message(message)
 
-            except_deleted(self.discord.edit_webhook)(
-                message.new_body, message_id, webhook
-            )
+                except_deleted(self.discord.edit_webhook)(
+                    message.new_body, message_id, webhook
+                )
+
+            self.edits.submit(("matrix", message.relates_to), edit)
         else:
-            message.body = (
-                f"`{message.body}`: {self.mxc_url(message.attachment)}"
-                if message.attachment
-                else self.process_message(message)
-            )
+            # Cache the event before it's body is converted for Discord.
+            event = strip_reply(message)
+
+            with tracing.span("convert"):
+                message.body = (
+                    f"`{message.body}`: {self.mxc_url(message.attachment)}"
+                    if message.attachment
+                    else self.process_message(message)
+                )
 
-            message_id = self.discord.send_webhook(
-                webhook,
+            args = (
                 self.mxc_url(author.avatar_url) if author.avatar_url else None,
                 message.body,
                 author.display_name if author.display_name else message.sender,
-            ).id
+            )
+
+            try:
+                with tracing.span("send"):
+                    message_id = self.discord.send_webhook(webhook, *args).id
+            except RequestError as e:
+                if e.status != 404:
+                    raise
 
-            with Cache.lock:
-                Cache.cache["m_messages"][message.id] = message_id
+                # The webhook was deleted from Discord's side.
+                self.logger.info(f"Recreating webhook for '{channel_id}'.")
+
+                with tracing.span("webhook"):
+                    webhook = self.discord.get_webhook(
+                        channel_id, self.discord.webhook_name, refresh=True
+                    )
+
+                with tracing.span("send"):
+                    message_id = self.discord.send_webhook(webhook, *args).id
+
+            self.m_messages.set(message.id, message_id)
+            self.m_events.set(message.id, event)
 
     def on_redaction(self, event: matrix.Event) -> None:
-        with Cache.lock:
-            message_id = Cache.cache["m_messages"].get(event.redacts)
+        # Edits to a redacted message don't need to be sent anymore.
+        self.edits.cancel(("matrix", event.redacts))
+
+        message_id = self.m_messages.get(event.redacts)
 
         if not message_id:
             return
@@ -151,28 +306,57 @@ class MatrixClient(AppService):
 
         except_deleted(self.discord.delete_webhook)(message_id, webhook)
 
-        with Cache.lock:
-            del Cache.cache["m_messages"][event.redacts]
+        self.m_messages.pop(event.redacts)
+        self.m_events.pop(event.redacts)
 
     def get_members(self, room_id: str) -> Dict[str, matrix.User]:
-        with Cache.lock:
-            cached = Cache.cache["m_members"].get(room_id)
+        cached = self.m_members.get(room_id)
 
         if cached:
             return cached
 
         resp = self.send("GET", f"/rooms/{room_id}/joined_members")
 
+        return self.cache_members(room_id, resp)
+
+    def cache_members(
+        self, room_id: str, resp: dict
+    ) -> Dict[str, matrix.User]:
         joined = resp["joined"]
 
         for k, v in joined.items():
             joined[k] = dict_cls(v, matrix.User)
 
-        with Cache.lock:
-            Cache.cache["m_members"][room_id] = joined
+        self.m_members.set(room_id, joined)
 
         return joined
 
+    async def fetch_members(self, rooms: List[str]) -> None:
+        """
+        Fetch the members for many rooms concurrently.
+        """
+
+        async with self.api:
+            results = await asyncio.gather(
+                *(
+                    self.api.send("GET", f"/rooms/{room}/joined_members")
+                    for room in rooms
+                ),
+                return_exceptions=True,
+            )
+
+        for room, resp in zip(rooms, results):
+            # We may have left some rooms, and prefetching is optional anyway
+            # so timeouts or bad responses don't stop us from starting.
+            if isinstance(resp, Exception):
+                self.logger.warning(
+                    f"Failed to fetch members for '{room}': {resp!r}"
+                )
+            elif isinstance(resp, BaseException):
+                raise resp
+            else:
+                self.cache_members(room, resp)
+
     def create_room(self, channel: discord.Channel, sender: str) -> None:
         """
         Create a bridged room and invite the person who invoked the command.
@@ -204,6 +388,9 @@ class MatrixClient(AppService):
 
         self.db.add_room(resp["room_id"], channel.id)
 
+        if self.workers:
+            self.workers.rooms_changed()
+
     def create_message_event(
         self,
         message: str,
@@ -216,7 +403,8 @@ class MatrixClient(AppService):
             "msgtype": "m.text",
         }
 
-        fmt = self.get_fmt(message, emotes)
+        with tracing.span("emotes"):
+            fmt = self.get_fmt(message, emotes)
 
         if fmt != message:
             content = {
@@ -229,49 +417,19 @@ class MatrixClient(AppService):
 
         if reference:
             # Reply to a Discord message.
-            with Cache.lock:
-                ref_id = Cache.cache["d_messages"].get(reference.id)
+            ref_id = self.d_messages.get(reference.id)
 
             # Reply to a Matrix message. (maybe)
             if not ref_id:
-                with Cache.lock:
-                    ref_id = [
-                        k
-                        for k, v in Cache.cache["m_messages"].items()
-                        if v == reference.id
-                    ]
-                    ref_id = next(iter(ref_id), "")
+                ref_id = self.m_messages.find(reference.id)
 
         if ref_id:
-            event = except_deleted(self.get_event)(
-                ref_id,
-                self.get_room_id(self.discord.matrixify(reference.channel_id)),
-            )
-            if event:
-                # Content with the reply fallbacks stripped.
-                tmp = ""
-                # We don't want to strip lines starting with "> " after
-                # encountering a regular line, so we use this variable.
-                got_fallback = True
-                for line in event.body.split("\n"):
-                    if not line.startswith("> "):
-                        got_fallback = False
-                    if not got_fallback:
-                        tmp += line
-
-                event.body = tmp
-                event.formatted_body = (
-                    # re.DOTALL allows the match to span newlines.
-                    re.sub(
-                        "<mx-reply.+?</mx-reply>",
-                        "",
-                        event.formatted_body,
-                        flags=re.DOTALL,
-                    )
-                    if event.formatted_body
-                    else event.body
+            with tracing.span("reply"):
+                event = self.get_reply_target(
+                    ref_id, self.db.get_room(reference.channel_id)
                 )
 
+            if event:
                 content = {
                     **content,
                     "body": (
@@ -298,13 +456,31 @@ class MatrixClient(AppService):
 
         return content
 
+    def get_reply_target(
+        self, event_id: str, room_id: str
+    ) -> Optional[matrix.Event]:
+        """
+        Get an event with it's reply fallbacks stripped, it is only fetched
+        from the homeserver if it isn't cached.
+        """
+
+        event = self.m_events.get(event_id)
+
+        if event:
+            return event
+
+        event = except_deleted(self.get_event)(event_id, room_id)
+
+        if not event:
+            return None
+
+        event = strip_reply(event)
+        self.m_events.set(event_id, event)
+
+        return event
+
     def get_fmt(self, message: str, emotes: dict) -> str:
-        message = (
-            markdown.markdown(message)
-            .replace("<p>", "")
-            .replace("</p>", "")
-            .replace("\n", "<br />")
-        )
+        message = formatting.render(message)
 
         # Upload emotes in multiple threads so that we don't
         # block the Discord bot for too long.
@@ -317,23 +493,22 @@ class MatrixClient(AppService):
 
         # Acquire the lock before starting the threads to avoid resource
         # contention by tens of threads at once.
-        with Cache.lock:
+        with self.emote_lock:
             for thread in upload_threads:
                 thread.start()
             for thread in upload_threads:
                 thread.join()
 
-        with Cache.lock:
-            for emote in emotes:
-                emote_ = Cache.cache["m_emotes"].get(emote)
+        for emote in emotes:
+            emote_ = self.m_emotes.get(emote)
 
-                if emote_:
-                    emote = f":{emote}:"
-                    message = message.replace(
-                        emote,
-                        f"""<img alt=\"{emote}\" title=\"{emote}\" \
+            if emote_:
+                emote = f":{emote}:"
+                message = message.replace(
+                    emote,
+                    f"""<img alt=\"{emote}\" title=\"{emote}\" \
 height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
-                    )
+                )
 
         return message
 
@@ -356,46 +531,57 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
     def process_message(self, event: matrix.Event) -> str:
         message = event.new_body if event.new_body else event.body
 
-        emotes = re.findall(r":(\w*):", message)
+        # { "text": "replacement" }
+        replacements = {}
+        mentions = {}  # { "mxid": match }
 
-        mentions = list(
-            re.finditer(
-                self.mention_regex(encode=False, id_as_group=True),
-                event.formatted_body,
-            )
-        )
-        # For clients that properly encode mentions.
-        # 'https://matrix.to/#/%40_discord_...%3Adomain.tld'
-        mentions.extend(
-            re.finditer(
-                self.mention_regex(encode=True, id_as_group=True),
-                event.formatted_body,
-            )
+        for regex in self.mention_regexes:
+            for mention in regex.finditer(event.formatted_body):
+                # Unquote just in-case we matched an encoded username.
+                mentions.setdefault(
+                    urllib.parse.unquote(mention.group(0)), mention
+                )
+
+        # Resolve all the mentioned users at once.
+        users = self.db.fetch_users(list(mentions)) if mentions else {}
+
+        for mxid, mention in mentions.items():
+            username = users[mxid].get("username")
+
+            if not username or mxid in replacements:
+                continue
+
+            if mention.group(2):
+                # Replace mention with plain text for hashed users (webhooks)
+                replacements[mxid] = f"@{username}"
+            else:
+                # Replace the 'mention' so that the user is tagged
+                # in the case of replies aswell.
+                # '> <@_discord_1234:localhost> Message'
+                replacements[mxid] = replacements[username] = (
+                    f"<@{mention.group(1)}>"
+                )
+
+        def replace(match: re.Match) -> str:
+            text = match.group(0)
+
+            # Remember the emotes as well, so that each one is only
+            # looked up once.
+            if text not in replacements:
+                replacements[text] = self.discord.d_emotes.get(
+                    match.group("emote"), text
+                )
+
+            return replacements[text]
+
+        regex = (
+            substitution_regex(tuple(replacements), self.emote_regex.pattern)
+            if replacements
+            else self.emote_regex
         )
 
-        with Cache.lock:
-            for emote in set(emotes):
-                emote_ = Cache.cache["d_emotes"].get(emote)
-                if emote_:
-                    message = message.replace(f":{emote}:", emote_)
-
-        for mention in set(mentions):
-            # Unquote just in-case we matched an encoded username.
-            username = self.db.fetch_user(
-                urllib.parse.unquote(mention.group(0))
-            ).get("username")
-            if username:
-                if mention.group(2):
-                    # Replace mention with plain text for hashed users (webhooks)
-                    message = message.replace(mention.group(0), f"@{username}")
-                else:
-                    # Replace the 'mention' so that the user is tagged
-                    # in the case of replies aswell.
-                    # '> <@_discord_1234:localhost> Message'
-                    for replace in (mention.group(0), username):
-                        message = message.replace(
-                            replace, f"<@{mention.group(1)}>"
-                        )
+        # Substitute all the mentions and emotes in a single pass.
+        message = regex.sub(replace, message)
 
         # We trim the message later as emotes take up extra characters too.
         return message[: discord.MESSAGE_LIMIT]
@@ -403,7 +589,7 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
     def upload_emote(self, emote_name: str, emote_id: str) -> None:
         # There won't be a race condition here, since only a unique
         # set of emotes are uploaded at a time.
-        if emote_name in Cache.cache["m_emotes"]:
+        if emote_name in self.m_emotes:
             return
 
         emote_url = f"{discord.CDN_URL}/emojis/{emote_id}"
@@ -411,10 +597,42 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
         # We don't want the message to be dropped entirely if an emote
         # fails to upload for some reason.
         try:
-            # TODO This is not thread safe, but we're protected by the GIL.
-            Cache.cache["m_emotes"][emote_name] = self.upload(emote_url)
+            mxc_url = self.upload(emote_url)
         except RequestError as e:
             self.logger.warning(f"Failed to upload emote {emote_id}: {e}")
+            return
+
+        self.m_emotes.set(emote_name, mxc_url)
+        self.db.add_emote(emote_name, mxc_url)
+
+    def share_emotes(self, emotes: List[discord.Emote]) -> None:
+        """
+        Upload the emotes that are missing in the background and send them
+        to the workers, so that they don't all upload the same emotes.
+        """
+
+        missing = [
+            emote for emote in emotes if emote.name not in self.m_emotes
+        ]
+
+        if missing:
+            threading.Thread(
+                target=self.upload_emotes, args=(missing,), daemon=True
+            ).start()
+
+    def upload_emotes(self, emotes: List[discord.Emote]) -> None:
+        with self.emote_lock:
+            for emote in emotes:
+                self.upload_emote(emote.name, emote.id)
+
+        uploaded = {
+            emote.name: self.m_emotes.peek(emote.name)
+            for emote in emotes
+            if emote.name in self.m_emotes
+        }
+
+        if uploaded:
+            self.workers.emotes_changed(uploaded)
 
     def register(self, mxid: str) -> None:
         """
@@ -427,10 +645,16 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
             "username": mxid[1:].split(":")[0],
         }
 
-        resp = self.send("POST", "/register", content)
+        try:
+            mxid = self.send("POST", "/register", content)["user_id"]
+        except RequestError as e:
+            # Another worker registered it first.
+            if e.status != 400 or "M_USER_IN_USE" not in str(e):
+                raise
 
-        self.db.add_user(resp["user_id"])
+        self.db.add_user(mxid)
 
+    @scheduler.priority(scheduler.PROFILE)
     def set_avatar(self, avatar_url: str, mxid: str) -> None:
         avatar_uri = self.upload(avatar_url)
 
@@ -443,6 +667,7 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
 
         self.db.add_avatar(avatar_url, mxid)
 
+    @scheduler.priority(scheduler.PROFILE)
     def set_nick(self, username: str, mxid: str) -> None:
         self.send(
             "PUT",
@@ -453,28 +678,145 @@ height=\"32\" src=\"{emote_}\" data-mx-emoticon />""",
 
         self.db.add_username(username, mxid)
 
+    def touch_room(self, room_id: str) -> None:
+        """
+        Remember that a room is active, this is saved at most once an hour
+        per room.
+        """
+
+        now = int(time.time())
+
+        if now - self.active.get(room_id, 0) < 3600:
+            return
+
+        self.active[room_id] = now
+        self.db.touch_room(room_id, now)
+
+    def warm_up(self) -> None:
+        """
+        Load all the persisted state into the caches, and fetch the members
+        of the most recently active rooms.
+        """
+
+        start = time.perf_counter()
+
+        profiles = self.db.warm_profiles()
+
+        for name, mxc_url in self.db.list_emotes().items():
+            self.m_emotes.set(name, mxc_url)
+
+        webhooks = self.discord.load_webhooks()
+
+        rooms = (
+            self.db.list_active_rooms(self.prefetch_members)
+            if self.prefetch_members
+            else []
+        )
+
+        if rooms:
+            asyncio.run(self.fetch_members(rooms))
+
+        self.logger.info(
+            f"Warmed up in {time.perf_counter() - start:.2f}s: "
+            f"{profiles} profiles, {len(self.m_emotes)} emotes, "
+            f"{len(self.db.channels)} rooms, {webhooks} webhooks, "
+            f"members for {len(self.m_members)}/{len(rooms)} rooms."
+        )
+
+    def replay(self, basedir: str) -> None:
+        """
+        Handle the events that were journaled when we were last stopped.
+        """
+
+        items = journal.load(basedir)
+
+        for item in items:
+            dispatch(self, item)
+
+        if items:
+            self.logger.info(f"Replayed {len(items)} journaled events.")
+
+    def shutdown(self, basedir: str, timeout: float) -> None:
+        """
+        Stop accepting transactions and finish the in-flight work within
+        `timeout` seconds, the queued events that are left are journaled.
+        """
+
+        deadline = time.monotonic() + timeout
+
+        self.stopping.set()
+
+        # Wait for the transaction that's being handled, if any.
+        if not self.transaction_lock.acquire(timeout=timeout):
+            self.logger.warning("Timed out waiting for a transaction.")
+
+        flushed = self.edits.flush()
+
+        if self.workers:
+            self.workers.stop(deadline)
+
+        self.discord.save_session(f"{basedir}/session.json")
+
+        self.logger.info(
+            f"Shut down in {timeout - (deadline - time.monotonic()):.2f}s, "
+            f"flushed {flushed} edits."
+        )
+
+    def compact_messages(self, interval: int = 60, budget: int = 500) -> None:
+        """
+        Periodically remove expired message mappings in small batches so that
+        handlers are never blocked on the cache for long.
+        """
+
+        while True:
+            time.sleep(interval)
+
+            removed = 0
+
+            for cache in (self.m_messages, self.d_messages, self.m_events):
+                while True:
+                    count = cache.compact(budget)
+                    removed += count
+
+                    if count < budget:
+                        break
+
+                    # Let the handlers grab the lock between batches.
+                    time.sleep(0)
+
+            if removed:
+                self.logger.info(
+                    f"Removed {removed} expired message mappings."
+                )
+
 
 class DiscordClient(Gateway):
     def __init__(
-        self, appservice: MatrixClient, config: dict, http: urllib3.PoolManager
+        self, appservice: MatrixClient, config: dict, pools: Pools
     ) -> None:
-        super().__init__(http, config["discord_token"])
+        super().__init__(pools, config["discord_token"], appservice.workers)
 
         self.app = appservice
         self.webhook_name = "matrix_bridge"
+        self.sync_workers = int(config.get("sync_workers", 4))
 
-        # TODO Find a cleaner way to use these keys.
-        for k in ("d_emotes", "d_messages", "d_webhooks"):
-            Cache.cache[k] = {}
+        # TODO maybe "namespace" emotes by guild in the cache ?
+        self.d_emotes = Cache("d_emotes", maxsize=50000)  # name: emote
+        self.d_webhooks = Cache("d_webhooks", maxsize=10000)  # id: webhook
 
-    def to_return(self, message: discord.Message) -> bool:
-        with Cache.lock:
-            hook_ids = [hook.id for hook in Cache.cache["d_webhooks"].values()]
+        # IDs of our own webhooks, to ignore the messages that we send.
+        self.webhook_ids = set()
 
+        # Batches of users whose profiles should be synced. A guild's members
+        # are shed first under pressure as they're synced again the next time
+        # that the guild is loaded.
+        self.profile_syncs = BoundedQueue("profile_syncs", 64, 32)
+
+    def to_return(self, message: discord.Message) -> bool:
         return (
-            message.channel_id not in self.app.db.list_channels()
+            not self.app.db.get_room(message.channel_id)
             or not message.author  # Embeds can be weird sometimes.
-            or message.webhook_id in hook_ids
+            or message.webhook_id in self.webhook_ids
         )
 
     def matrixify(self, id: str, user: bool = False, hashed: str = "") -> str:
@@ -497,6 +839,11 @@ class DiscordClient(Gateway):
         if not profile:
             return
 
+        self.update_profile(user, mxid, profile)
+
+    def update_profile(
+        self, user: discord.User, mxid: str, profile: dict
+    ) -> None:
         username = f"{user.username}#{user.discriminator}"
 
         if user.avatar_url != profile["avatar_url"]:
@@ -506,6 +853,60 @@ class DiscordClient(Gateway):
             self.logger.info(f"Updating username for Discord user '{user.id}'")
             self.app.set_nick(username, mxid)
 
+    def sync_profiles(self, users: List[discord.User]) -> None:
+        """
+        Sync the profiles for a list of users in bulk, only the puppets whose
+        avatar or username changed are updated.
+        """
+
+        mxids = [self.matrixify(user.id, user=True) for user in users]
+
+        # Most of a guild's members aren't puppets, so they're diffed against
+        # all the puppets at once instead of filling the profile cache with
+        # misses.
+        profiles = (
+            self.app.db.fetch_users(mxids)
+            if len(mxids) <= SYNC_LOOKUP_LIMIT
+            else self.app.db.fetch_users()
+        )
+        changed = []
+
+        for user in users:
+            mxid = self.matrixify(user.id, user=True)
+            profile = profiles.get(mxid)
+
+            # The avatar URL contains the avatar's hash.
+            if profile and (
+                user.avatar_url != profile["avatar_url"]
+                or f"{user.username}#{user.discriminator}"
+                != profile["username"]
+            ):
+                changed.append((user, mxid, profile))
+
+        if not changed:
+            return
+
+        self.logger.info(
+            f"Syncing {len(changed)} changed profiles out of {len(users)}."
+        )
+
+        # Log the progress roughly every 10%.
+        step = max(len(changed) // 10, 1)
+
+        with ThreadPoolExecutor(max_workers=self.sync_workers) as pool:
+            futures = [
+                pool.submit(self.update_profile, *args) for args in changed
+            ]
+
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    future.result()
+                except Exception:
+                    self.logger.exception("Failed to sync profile:")
+
+                if done % step == 0 or done == len(changed):
+                    self.logger.info(f"Synced {done}/{len(changed)} profiles.")
+
     def wrap(self, message: discord.Message) -> Tuple[str, str]:
         """
         Get the room ID and the puppet's mxid for a given channel ID and a
@@ -517,59 +918,113 @@ class DiscordClient(Gateway):
             hashed = str(hash_str(message.author.username))
 
         mxid = self.matrixify(message.author.id, user=True, hashed=hashed)
-        room_id = self.app.get_room_id(self.matrixify(message.channel_id))
 
-        if not self.app.db.fetch_user(mxid):
+        with tracing.span("lookup"):
+            room_id = self.app.db.get_room(message.channel_id)
+            registered = self.app.db.fetch_user(mxid)
+
+        tracing.tag(room=room_id)
+
+        self.app.touch_room(room_id)
+
+        if not registered:
             self.logger.info(
                 f"Creating dummy user for Discord user {message.author.id}."
             )
-            self.app.register(mxid)
 
-            self.app.set_nick(
-                f"{message.author.username}#"
-                f"{message.author.discriminator}",
-                mxid,
-            )
+            with tracing.span("register"):
+                self.app.register(mxid)
 
-            if message.author.avatar_url:
-                self.app.set_avatar(message.author.avatar_url, mxid)
+                self.app.set_nick(
+                    f"{message.author.username}#"
+                    f"{message.author.discriminator}",
+                    mxid,
+                )
 
-        if mxid not in self.app.get_members(room_id):
-            self.logger.info(f"Inviting user '{mxid}' to room '{room_id}'.")
+                if message.author.avatar_url:
+                    self.app.set_avatar(message.author.avatar_url, mxid)
+
+        with tracing.span("members"):
+            if mxid not in self.app.get_members(room_id):
+                self.logger.info(
+                    f"Inviting user '{mxid}' to room '{room_id}'."
+                )
 
-            self.app.send_invite(room_id, mxid)
-            self.app.join_room(room_id, mxid)
+                self.app.send_invite(room_id, mxid)
+                self.app.join_room(room_id, mxid)
 
         if message.webhook_id:
             # Sync webhooks here as they can't be accessed like guild members.
-            self.sync_profile(message.author, hashed=hashed)
+            with tracing.span("profile"):
+                self.sync_profile(message.author, hashed=hashed)
 
         return mxid, room_id
 
     def cache_emotes(self, emotes: List[discord.Emote]):
-        # TODO maybe "namespace" emotes by guild in the cache ?
-        with Cache.lock:
-            for emote in emotes:
-                Cache.cache["d_emotes"][emote.name] = (
-                    f"<{'a' if emote.animated else ''}:"
-                    f"{emote.name}:{emote.id}>"
-                )
+        for emote in emotes:
+            self.d_emotes.set(
+                emote.name,
+                f"<{'a' if emote.animated else ''}:{emote.name}:{emote.id}>",
+            )
+
+    def queue_profiles(
+        self, users: List[discord.User], droppable: bool = True
+    ) -> None:
+        """
+        Queue users for syncing their profiles in the background, so that the
+        gateway isn't blocked. Droppable syncs are shed under load, the
+        others wait for space.
+        """
+
+        if not self.profile_syncs.put(users, droppable=droppable):
+            self.logger.info(f"Dropped profile sync for {len(users)} users.")
+
+    def run_profile_syncs(self) -> None:
+        """
+        Sync the queued profiles, multiple queued batches are synced at once.
+        """
+
+        while True:
+            users = {user.id: user for user in self.profile_syncs.get()}
+
+            # The latest update for a user wins.
+            while len(users) < 1000:
+                try:
+                    batch = self.profile_syncs.get_nowait()
+                except queue.Empty:
+                    break
+
+                users.update((user.id, user) for user in batch)
+
+            try:
+                self.sync_profiles(list(users.values()))
+            except Exception:
+                self.logger.exception("Failed to sync profiles:")
+
+    def dead_letter(self, item: dict, error: Exception) -> None:
+        self.app.dead_letters.add(item, error)
 
     def on_guild_create(self, guild: discord.Guild) -> None:
-        for member in guild.members:
-            self.sync_profile(member)
+        self.queue_profiles(guild.members)
 
         self.cache_emotes(guild.emojis)
 
+        if self.app.workers:
+            self.app.share_emotes(guild.emojis)
+
     def on_guild_emojis_update(
         self, update: discord.GuildEmojisUpdate
     ) -> None:
         self.cache_emotes(update.emojis)
 
+        if self.app.workers:
+            self.app.share_emotes(update.emojis)
+
     def on_guild_member_update(
         self, update: discord.GuildMemberUpdate
     ) -> None:
-        self.sync_profile(update.user)
+        # Unlike a guild's members, a single update isn't sent again.
+        self.queue_profiles([update.user], droppable=False)
 
     def on_message_create(self, message: discord.Message) -> None:
         if self.to_return(message):
@@ -577,44 +1032,59 @@ class DiscordClient(Gateway):
 
         mxid, room_id = self.wrap(message)
 
-        content_, emotes = self.process_message(message)
+        with tracing.span("convert"):
+            content_, emotes = self.process_message(message)
 
         content = self.app.create_message_event(
             content_, emotes, reference=message.referenced_message
         )
 
-        with Cache.lock:
-            Cache.cache["d_messages"][message.id] = self.app.send_message(
-                room_id, content, mxid
-            )
+        with tracing.span("send"):
+            event_id = self.app.send_message(room_id, content, mxid)
+
+        self.app.d_messages.set(message.id, event_id)
+        self.app.m_events.set(
+            event_id,
+            strip_reply(
+                matrix.Event(
+                    {
+                        "event_id": event_id,
+                        "room_id": room_id,
+                        "sender": mxid,
+                        "content": content,
+                    }
+                )
+            ),
+        )
 
     def on_message_delete(self, message: discord.Message) -> None:
-        with Cache.lock:
-            event_id = Cache.cache["d_messages"].get(message.id)
+        self.app.edits.cancel(("discord", message.id))
+
+        event_id = self.app.d_messages.get(message.id)
 
         if not event_id:
             return
 
-        room_id = self.app.get_room_id(self.matrixify(message.channel_id))
-        event = except_deleted(self.app.get_event)(event_id, room_id)
+        room_id = self.app.db.get_room(message.channel_id)
+        event = self.app.m_events.pop(event_id) or except_deleted(
+            self.app.get_event
+        )(event_id, room_id)
 
         if event:
             self.app.redact(event.id, event.room_id, event.sender)
 
-        with Cache.lock:
-            del Cache.cache["d_messages"][message.id]
+        self.app.d_messages.pop(message.id)
 
     def on_message_update(self, message: discord.Message) -> None:
         if self.to_return(message):
             return
 
-        with Cache.lock:
-            event_id = Cache.cache["d_messages"].get(message.id)
+        event_id = self.app.d_messages.get(message.id)
 
         if not event_id:
             return
 
-        room_id = self.app.get_room_id(self.matrixify(message.channel_id))
+        room_id = self.app.db.get_room(message.channel_id)
         mxid = self.matrixify(message.author.id, user=True)
 
         # It is possible that a webhook edit's it's own old message
@@ -625,35 +1095,66 @@ class DiscordClient(Gateway):
         if not self.app.db.fetch_user(mxid):
             return
 
-        content_, emotes = self.process_message(message)
+        @scheduler.priority(scheduler.EDIT)
+        def edit() -> None:
+            content_, emotes = self.process_message(message)
 
-        content = self.app.create_message_event(
-            content_, emotes, edit=event_id
-        )
+            content = self.app.create_message_event(
+                content_, emotes, edit=event_id
+            )
+
+            self.app.send_message(room_id, content, mxid)
 
-        self.app.send_message(room_id, content, mxid)
+        self.app.edits.submit(("discord", message.id), edit)
 
     def on_typing_start(self, typing: discord.Typing) -> None:
-        if typing.channel_id not in self.app.db.list_channels():
+        room_id = self.app.db.get_room(typing.channel_id)
+
+        if not room_id:
             return
 
         mxid = self.matrixify(typing.user_id, user=True)
-        room_id = self.app.get_room_id(self.matrixify(typing.channel_id))
 
         if mxid not in self.app.get_members(room_id):
             return
 
         self.app.send_typing(room_id, mxid)
 
-    def get_webhook(self, channel_id: str, name: str) -> discord.Webhook:
+    def load_webhooks(self) -> int:
+        """
+        Load the saved webhooks, returns the number of loaded webhooks.
+        """
+
+        webhooks = self.app.db.list_webhooks()
+
+        for channel_id, webhook in webhooks.items():
+            self.cache_webhook(
+                channel_id,
+                discord.Webhook(webhook["webhook_id"], webhook["token"]),
+            )
+
+        return len(webhooks)
+
+    def cache_webhook(self, channel_id: str, webhook: discord.Webhook) -> None:
+        old = self.d_webhooks.peek(channel_id)
+
+        if old and old.id != webhook.id:
+            self.webhook_ids.discard(old.id)
+
+        self.webhook_ids.add(webhook.id)
+        self.d_webhooks.set(channel_id, webhook)
+
+    def get_webhook(
+        self, channel_id: str, name: str, refresh: bool = False
+    ) -> discord.Webhook:
         """
         Get the webhook object for the first webhook that matches the specified
         name in a given channel, create the webhook if it doesn't exist.
+        `refresh` skips the cache, in-case the cached webhook was deleted.
         """
 
         # Check the cache first.
-        with Cache.lock:
-            webhook = Cache.cache["d_webhooks"].get(channel_id)
+        webhook = None if refresh else self.d_webhooks.get(channel_id)
 
         if webhook:
             return webhook
@@ -671,58 +1172,65 @@ class DiscordClient(Gateway):
         if not webhook:
             webhook = self.create_webhook(channel_id, name)
 
-        with Cache.lock:
-            Cache.cache["d_webhooks"][channel_id] = webhook
+        self.cache_webhook(channel_id, webhook)
+        self.app.db.add_webhook(channel_id, webhook.id, webhook.token)
 
         return webhook
 
     def process_message(self, message: discord.Message) -> Tuple[str, Dict]:
-        content = message.content
-        emotes = {}
-        regex = r"<a?:(\w+):(\d+)>"
-
-        # Mentions can either be in the form of `<@1234>` or `<@!1234>`.
-        for member in message.mentions:
-            for char in ("", "!"):
-                content = content.replace(
-                    f"<@{char}{member.id}>", f"@{member.username}"
-                )
+        emotes = {}  # { "emote_name": "emote_id" }
+        mentions = {member.id: member.username for member in message.mentions}
+        channels = None  # Only fetched if a channel is mentioned.
 
-        # Replace channel IDs with names.
-        channels = re.findall("<#([0-9]+)>", content)
-        if channels:
-            if not message.guild_id:
-                self.logger.warning(
-                    f"Message '{message.id}' in channel '{message.channel_id}' does not have a guild_id!"
+        def replace(match: re.Match) -> str:
+            nonlocal channels
+
+            user, channel, emote, emote_id = match.groups()
+
+            if user:
+                username = mentions.get(user)
+
+                return f"@{username}" if username else match.group(0)
+
+            if channel:
+                if channels is None:
+                    if not message.guild_id:
+                        self.logger.warning(
+                            f"Message '{message.id}' in channel "
+                            f"'{message.channel_id}' does not have a guild_id!"
+                        )
+                        channels = {}
+                    else:
+                        channels = self.get_channels(message.guild_id)
+
+                if not message.guild_id:
+                    return match.group(0)
+
+                discord_channel = channels.get(channel)
+
+                return (
+                    f"#{discord_channel.name}"
+                    if discord_channel
+                    else "#deleted-channel"
                 )
-            else:
-                discord_channels = self.get_channels(message.guild_id)
-                for channel in channels:
-                    discord_channel = discord_channels.get(channel)
-                    name = (
-                        discord_channel.name
-                        if discord_channel
-                        else "deleted-channel"
-                    )
-                    content = content.replace(f"<#{channel}>", f"#{name}")
 
-        # { "emote_name": "emote_id" }
-        for emote in re.findall(regex, content):
-            emotes[emote[0]] = emote[1]
+            emotes[emote] = emote_id
 
-        # Replace emote IDs with names.
-        content = re.sub(regex, r":\g<1>:", content)
+            return f":{emote}:"
+
+        # Replace mentions, channel IDs and emote IDs with names in one pass.
+        content = [TOKEN_REGEX.sub(replace, message.content)]
 
         # Append attachments to message.
         for attachment in message.attachments:
-            content += f"\n{attachment['url']}"
+            content.append(attachment["url"])
 
         # Append stickers to message.
         for sticker in message.stickers:
             if sticker.format_type != 3:  # 3 == Lottie format.
-                content += f"\n{discord.CDN_URL}/stickers/{sticker.id}.png"
+                content.append(f"{discord.CDN_URL}/stickers/{sticker.id}.png")
 
-        return content, emotes
+        return "\n".join(content), emotes
 
 
 def config_gen(basedir: str, config_file: str) -> dict:
@@ -735,8 +1243,29 @@ def config_gen(basedir: str, config_file: str) -> dict:
         "homeserver": "http://127.0.0.1:8008",
         "server_name": "localhost",
         "discord_token": "my-secret-discord-token",
+        "discord_api": discord.API_URL,
+        "discord_cdn": discord.CDN_URL,
         "port": 5000,
         "database": f"{basedir}/bridge.db",
+        "database_engine": "sqlite",
+        "sync_workers": 4,
+        "message_retention": 604800,
+        "message_limit": 100000,
+        "prefetch_members": 50,
+        "reply_cache_size": 10000,
+        "edit_window": 0,
+        "max_requests": 10,
+        "workers": 0,
+        "queue_size": 1000,
+        "queue_high_water": 800,
+        "queue_timeout": 10,
+        "shutdown_timeout": 10,
+        "max_retries": 3,
+        "circuit_threshold": 5,
+        "circuit_reset": 30,
+        "pools": POOL_DEFAULTS,
+        "slow_message_log": 0,
+        "metrics_token": "",
     }
 
     if not os.path.exists(config_file):
@@ -771,18 +1300,32 @@ def main() -> None:
 
     config = config_gen(basedir, "appservice.json")
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s %(name)s:%(levelname)s:%(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-        handlers=[
-            logging.FileHandler(f"{basedir}/appservice.log"),
-        ],
-    )
+    setup_logging(f"{basedir}/appservice.log")
 
     sys.excepthook = excepthook
 
-    app = MatrixClient(config, urllib3.PoolManager(maxsize=10))
+    # Every outgoing API request needs one of it's pool's connections.
+    pools = Pools(config.get("pools", {}))
+    scheduler.configure(pools.maxsize)
+    configure_resilience(config)
+    configure_discord(config)
+    configure_tracing(config)
+
+    workers = int(config.get("workers", 0))
+    router = Router(basedir, config, workers) if workers else None
+
+    app = MatrixClient(config, pools, router)
+
+    if router:
+        router.start(app.db)
+
+    # Fill the caches before accepting any transactions.
+    app.warm_up()
+
+    # Finish what was left over when we were last stopped, then continue
+    # where we left off in the gateway.
+    app.replay(basedir)
+    app.discord.load_session(f"{basedir}/session.json")
 
     # Start the bottle app in a separate thread.
     app_thread = threading.Thread(
@@ -790,10 +1333,88 @@ def main() -> None:
     )
     app_thread.start()
 
+    # Forget old message mappings in the background.
+    threading.Thread(target=app.compact_messages, daemon=True).start()
+
+    threading.Thread(target=app.discord.run_profile_syncs, daemon=True).start()
+
+    start_dead_letters(app, f"{basedir}/dead-letters.jsonl")
+
     try:
+        # Returns once we're told to stop.
         asyncio.run(app.discord.run())
     except KeyboardInterrupt:
-        sys.exit()
+        pass
+
+    app.shutdown(basedir, float(config.get("shutdown_timeout", 10)))
+
+
+def setup_logging(log_file: str) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(name)s:%(levelname)s:%(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        handlers=[
+            logging.FileHandler(log_file),
+        ],
+    )
+
+
+def configure_resilience(config: dict) -> None:
+    resilience.configure(
+        int(config.get("max_retries", 3)),
+        int(config.get("circuit_threshold", 5)),
+        float(config.get("circuit_reset", 30)),
+    )
+
+
+def configure_tracing(config: dict) -> None:
+    tracing.configure(float(config.get("slow_message_log", 0)))
+
+
+def configure_discord(config: dict) -> None:
+    # Both can point to local servers for benchmarking.
+    discord.API_URL = config.get("discord_api", discord.API_URL)
+    discord.CDN_URL = config.get("discord_cdn", discord.CDN_URL)
+
+
+def start_dead_letters(app: MatrixClient, path: str) -> None:
+    """
+    Persist dead letters to `path` and replay them in the background once
+    the destinations recover.
+    """
+
+    app.dead_letters.open(path)
+
+    threading.Thread(
+        target=app.dead_letters.run,
+        args=(lambda item: dispatch(app, item),),
+        daemon=True,
+    ).start()
+
+
+def setup_worker(idx: int, basedir: str, config: dict) -> MatrixClient:
+    """
+    Create the client for a worker process, which handles the events that
+    are forwarded to it instead of receiving them itself.
+    """
+
+    setup_logging(f"{basedir}/appservice-worker-{idx}.log")
+
+    pools = Pools(config.get("pools", {}))
+    scheduler.configure(pools.maxsize)
+    configure_resilience(config)
+    configure_discord(config)
+    configure_tracing(config)
+
+    app = MatrixClient(config, pools)
+    app.warm_up()
+
+    threading.Thread(target=app.compact_messages, daemon=True).start()
+
+    start_dead_letters(app, f"{basedir}/dead-letters-worker-{idx}.jsonl")
+
+    return app
 
 
 if __name__ == "__main__":
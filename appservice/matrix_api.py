@@ -0,0 +1,252 @@
+import asyncio
+import json
+import time
+import urllib.parse
+import uuid
+from typing import Union
+
+import aiohttp
+
+import matrix
+import metrics
+from cache import Cache
+from errors import RequestError
+from misc import retry_after
+from resilience import BREAKERS, RETRY
+
+
+class MatrixAPI:
+    """
+    An asyncio client for the homeserver's client-server API with the same
+    methods as `AppService`, so that many requests can be awaited at once.
+    Connections are reused and at most `max_requests` requests are made
+    concurrently. Requests go through the homeserver's circuit breaker and
+    are retried like `AppService`'s, but they skip it's scheduler as they're
+    only made while warming up, before anything else is bridged.
+    """
+
+    destination = "homeserver"
+
+    def __init__(
+        self,
+        base_url: str,
+        as_token: str,
+        max_requests: int = 10,
+        m_rooms: Cache = None,
+    ) -> None:
+        self.base_url = base_url
+        self.as_token = as_token
+        self.max_requests = max_requests
+        self.m_rooms = m_rooms  # alias: room_id
+
+        # Both are bound to the event loop that they were created in.
+        self.session: aiohttp.ClientSession = None
+        self.semaphore: asyncio.Semaphore = None
+
+    async def __aenter__(self) -> "MatrixAPI":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if not self.session or self.session.closed:
+            # The token is only sent to the homeserver by `send_once`, as
+            # files are downloaded from other hosts with the same session.
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_requests)
+            )
+            self.semaphore = asyncio.Semaphore(self.max_requests)
+
+        return self.session
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+
+        self.session = self.semaphore = None
+
+    async def join_room(self, room_id: str, mxid: str = "") -> None:
+        await self.send(
+            "POST",
+            f"/join/{room_id}",
+            params={"user_id": mxid} if mxid else {},
+        )
+
+    async def redact(
+        self, event_id: str, room_id: str, mxid: str = ""
+    ) -> None:
+        await self.send(
+            "PUT",
+            f"/rooms/{room_id}/redact/{event_id}/{uuid.uuid4()}",
+            params={"user_id": mxid} if mxid else {},
+        )
+
+    async def get_room_id(self, alias: str) -> str:
+        room = self.m_rooms.get(alias) if self.m_rooms is not None else None
+        if room:
+            return room
+
+        resp = await self.send(
+            "GET", f"/directory/room/{urllib.parse.quote(alias)}"
+        )
+
+        room_id = resp["room_id"]
+
+        if self.m_rooms is not None:
+            self.m_rooms.set(alias, room_id)
+
+        return room_id
+
+    async def get_event(self, event_id: str, room_id: str) -> matrix.Event:
+        resp = await self.send("GET", f"/rooms/{room_id}/event/{event_id}")
+
+        return matrix.Event(resp)
+
+    async def upload(self, url: str) -> str:
+        """
+        Upload a file to the homeserver and get the MXC url.
+        """
+
+        async with self.get_session().get(url) as resp:
+            data = await resp.read()
+            content_type = resp.headers.get("Content-Type")
+
+        resp = await self.send(
+            "POST",
+            content=data,
+            content_type=content_type,
+            params={"filename": f"{uuid.uuid4()}"},
+            endpoint="/_matrix/media/r0/upload",
+        )
+
+        return resp["content_uri"]
+
+    async def send_message(
+        self,
+        room_id: str,
+        content: dict,
+        mxid: str = "",
+    ) -> str:
+        resp = await self.send(
+            "PUT",
+            f"/rooms/{room_id}/send/m.room.message/{uuid.uuid4()}",
+            content,
+            {"user_id": mxid} if mxid else {},
+        )
+
+        return resp["event_id"]
+
+    async def send_typing(
+        self, room_id: str, mxid: str = "", timeout: int = 8000
+    ) -> None:
+        await self.send(
+            "PUT",
+            f"/rooms/{room_id}/typing/{mxid}",
+            {"typing": True, "timeout": timeout},
+            {"user_id": mxid} if mxid else {},
+        )
+
+    async def send_invite(self, room_id: str, mxid: str) -> None:
+        await self.send("POST", f"/rooms/{room_id}/invite", {"user_id": mxid})
+
+    async def send(
+        self,
+        method: str,
+        path: str = "",
+        content: Union[bytes, dict] = {},
+        params: dict = {},
+        content_type: str = "application/json",
+        endpoint: str = "/_matrix/client/r0",
+    ) -> dict:
+        """
+        Either return json data or raise a `RequestError` if the request was
+        unsuccessful, like `AppService.send`.
+        """
+
+        labels = {"destination": self.destination, "method": method}
+        breaker = BREAKERS[self.destination]
+
+        payload = json.dumps(content) if isinstance(content, dict) else content
+        endpoint = (
+            f"{self.base_url}{endpoint}{path}?"
+            f"{urllib.parse.urlencode(params)}"
+        )
+
+        for attempt in range(RETRY.max_retries + 1):
+            if not breaker.allow():
+                raise RequestError(
+                    None, f"Failing fast, '{self.destination}' is down."
+                )
+
+            try:
+                resp = await self.send_once(
+                    method, endpoint, payload, content_type, labels
+                )
+            except RequestError as e:
+                if e.transient and e.status != 429:
+                    breaker.failure()
+                else:
+                    breaker.success()
+
+                if attempt == RETRY.max_retries or not RETRY.retryable(
+                    method, e.status, e.unsent
+                ):
+                    raise
+
+                metrics.REQUEST_RETRIES.inc(**labels)
+                await asyncio.sleep(RETRY.delay(attempt, e.retry_after))
+                continue
+
+            breaker.success()
+
+            return resp
+
+    async def send_once(
+        self,
+        method: str,
+        endpoint: str,
+        payload: Union[bytes, str],
+        content_type: str,
+        labels: dict,
+    ) -> dict:
+        session = self.get_session()
+
+        async with self.semaphore:
+            start = time.perf_counter()
+
+            try:
+                async with session.request(
+                    method,
+                    endpoint,
+                    data=payload,
+                    headers={
+                        "Authorization": f"Bearer {self.as_token}",
+                        "Content-Type": content_type,
+                    },
+                ) as resp:
+                    status = resp.status
+                    headers = resp.headers
+                    data = await resp.read()
+            except aiohttp.ClientError as e:
+                metrics.REQUEST_ERRORS.inc(status="none", **labels)
+                error = RequestError(None, f"Failed to connect: {e}")
+                error.unsent = isinstance(e, aiohttp.ClientConnectorError)
+
+                raise error from None
+            finally:
+                metrics.REQUEST_LATENCY.observe(
+                    time.perf_counter() - start, **labels
+                )
+
+        if status < 200 or status >= 300:
+            metrics.REQUEST_ERRORS.inc(status=status, **labels)
+            error = RequestError(
+                status,
+                f"Failed to get response from '{endpoint}':\n{data}",
+            )
+            error.retry_after = retry_after(status, headers, data)
+
+            raise error
+
+        return {} if status == 204 else json.loads(data)
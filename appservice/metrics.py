@@ -0,0 +1,304 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from cache import Cache
+from queues import QUEUES
+from scheduler import SCHEDULERS
+
+# All the registered metrics, in the order in which they were created.
+REGISTRY: List["Metric"] = []
+
+# Latency buckets in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metric:
+    """
+    A metric with optional labels, `collect` can be used to compute the values
+    when the metrics are scraped instead of on every update.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        collect: Callable[[], Dict[tuple, float]] = None,
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values = {}  # labels: value
+
+        REGISTRY.append(self)
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        if self.collect:
+            return [(self.name, k, v) for k, v in self.collect().items()]
+
+        with self.lock:
+            return [(self.name, k, v) for k, v in self.values.items()]
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, description: str, buckets: tuple = BUCKETS
+    ) -> None:
+        super().__init__(name, description)
+
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            # [bucket counts..., +Inf count, sum]
+            values = self.values.get(key)
+
+            if not values:
+                values = self.values[key] = [0] * (len(self.buckets) + 2)
+
+            values[idx] += 1
+            values[-1] += value
+
+    def time(self, **labels) -> "Timer":
+        return Timer(self, labels)
+
+    def samples(self) -> List[Tuple[str, tuple, float]]:
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+
+        samples = []
+
+        for labels, values in items:
+            count = 0
+
+            for bound, bucket in zip(self.buckets + ("+Inf",), values):
+                count += bucket
+                samples.append(
+                    (f"{self.name}_bucket", labels + (("le", bound),), count)
+                )
+
+            samples.append((f"{self.name}_sum", labels, values[-1]))
+            samples.append((f"{self.name}_count", labels, count))
+
+        return samples
+
+
+class Timer:
+    """
+    Observe the time spent in a `with` block.
+    """
+
+    def __init__(self, histogram: Histogram, labels: dict) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def render() -> str:
+    """
+    Render all the metrics in the Prometheus text format.
+    """
+
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+REQUEST_LATENCY = Histogram(
+    "bridge_request_seconds", "Latency of outgoing HTTP requests."
+)
+REQUEST_ERRORS = Counter(
+    "bridge_request_errors_total", "Failed outgoing HTTP requests."
+)
+DB_LOCK_WAIT = Histogram(
+    "bridge_db_lock_wait_seconds", "Time spent waiting for the database lock."
+)
+DB_QUERY = Histogram(
+    "bridge_db_query_seconds", "Time spent executing database queries."
+)
+REQUEST_RETRIES = Counter(
+    "bridge_request_retries_total", "Outgoing HTTP requests that were retried."
+)
+CIRCUIT_STATE = Gauge(
+    "bridge_circuit_state",
+    "State of a destination's circuit breaker, 0 is closed, 1 is open and 2 "
+    "is half-open.",
+)
+DEAD_LETTERS = Counter(
+    "bridge_dead_letters_total",
+    "Events that were saved for later as a destination was unavailable.",
+)
+DEAD_LETTERS_REPLAYED = Counter(
+    "bridge_dead_letters_replayed_total", "Dead-lettered events replayed."
+)
+POOL_SIZE = Gauge(
+    "bridge_pool_size", "Maximum connections per host of a destination."
+)
+POOL_IN_USE = Gauge(
+    "bridge_pool_connections_in_use", "Connections in use by a destination."
+)
+POOL_WAIT = Histogram(
+    "bridge_pool_wait_seconds", "Time spent waiting for a free connection."
+)
+POOL_CONNECTIONS = Counter(
+    "bridge_pool_connections_total",
+    "Connections taken from a pool, by whether they were reused.",
+)
+STAGE_LATENCY = Histogram(
+    "bridge_stage_seconds",
+    "Time spent in each stage of bridging an event, by event type.",
+)
+TRACE_LATENCY = Histogram(
+    "bridge_trace_seconds",
+    "Time from receiving an event to bridging it, by event type.",
+)
+GATEWAY_EVENTS = Counter(
+    "bridge_gateway_events_total", "Dispatch events received from Discord."
+)
+GATEWAY_DISPATCH = Histogram(
+    "bridge_gateway_dispatch_seconds", "Time spent handling dispatch events."
+)
+GATEWAY_SEQ = Gauge(
+    "bridge_gateway_seq", "The last sequence number received from Discord."
+)
+GATEWAY_SEQ_GAPS = Counter(
+    "bridge_gateway_seq_gaps_total",
+    "Sequence numbers that were skipped by the gateway.",
+)
+GATEWAY_HEARTBEAT = Gauge(
+    "bridge_gateway_heartbeat_seconds",
+    "Time between the last heartbeat and it's acknowledgement.",
+)
+
+COALESCED_CALLS = Counter(
+    "bridge_coalesced_calls_total",
+    "Requests that weren't made as they were superseded or cancelled.",
+)
+
+
+def cache_stat(stat: str) -> Callable[[], Dict[tuple, float]]:
+    def collect() -> Dict[tuple, float]:
+        return {
+            (("cache", name),): cache.stats()[stat]
+            for name, cache in list(Cache.caches.items())
+        }
+
+    return collect
+
+
+def scheduler_stat(stat: str) -> Callable[[], Dict[tuple, float]]:
+    def collect() -> Dict[tuple, float]:
+        return {
+            (("destination", destination), ("priority", name)): value
+            for destination, scheduler in SCHEDULERS.items()
+            for name, value in scheduler.stats()[stat].items()
+        }
+
+    return collect
+
+
+SCHEDULER_DEPTH = Gauge(
+    "bridge_scheduler_queue_depth",
+    "Requests waiting for a free slot, by destination and priority class.",
+    scheduler_stat("depth"),
+)
+SCHEDULER_DROPPED = Counter(
+    "bridge_scheduler_dropped_total",
+    "Low priority requests dropped as there was no free slot.",
+    scheduler_stat("dropped"),
+)
+
+
+def queue_stat(stat: str) -> Callable[[], Dict[tuple, float]]:
+    def collect() -> Dict[tuple, float]:
+        return {
+            (("queue", name),): queue.stats()[stat]
+            for name, queue in list(QUEUES.items())
+        }
+
+    return collect
+
+
+QUEUE_DEPTH = Gauge(
+    "bridge_queue_depth", "Items waiting in a queue.", queue_stat("size")
+)
+QUEUE_SHED = Counter(
+    "bridge_queue_shed_total",
+    "Droppable items that were shed as a queue was over it's high-water mark.",
+    queue_stat("shed"),
+)
+QUEUE_REJECTED = Counter(
+    "bridge_queue_rejected_total",
+    "Items that were rejected as a queue stayed full.",
+    queue_stat("rejected"),
+)
+CACHE_SIZE = Gauge(
+    "bridge_cache_entries", "Number of entries in a cache.", cache_stat("size")
+)
+CACHE_HITS = Counter(
+    "bridge_cache_hits_total", "Cache hits.", cache_stat("hits")
+)
+CACHE_MISSES = Counter(
+    "bridge_cache_misses_total", "Cache misses.", cache_stat("misses")
+)
+CACHE_EVICTIONS = Counter(
+    "bridge_cache_evictions_total",
+    "Entries evicted from a cache due to it's size bound.",
+    cache_stat("evictions"),
+)
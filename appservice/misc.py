@@ -1,10 +1,14 @@
 import json
+import time
 from dataclasses import fields
-from typing import Any
+from typing import Any, Mapping
 
 import urllib3
 
+import metrics
 from errors import RequestError
+from resilience import BREAKERS, RETRY
+from scheduler import PRIORITY, SCHEDULERS, TYPING
 
 
 def dict_cls(d: dict, cls: Any) -> Any:
@@ -36,26 +40,120 @@ def log_except(fn):
 def request(fn):
     """
     Either return json data or raise a `RequestError` if the request was
-    unsuccessful.
+    unsuccessful. Transient failures are retried with a backoff, and
+    requests fail fast while the destination's circuit breaker is open.
     """
 
-    def wrapper(*args, **kwargs):
-        try:
-            resp = fn(*args, **kwargs)
-        except urllib3.exceptions.HTTPError as e:
-            raise RequestError(None, f"Failed to connect: {e}") from None
+    def wrapper(self, method: str, *args, **kwargs):
+        labels = {"destination": self.destination, "method": method}
+        breaker = BREAKERS[self.destination]
+        level = PRIORITY.get()
+
+        # Droppable requests aren't worth retrying.
+        retries = RETRY.max_retries if level < TYPING else 0
+
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise RequestError(
+                    None, f"Failing fast, '{self.destination}' is down."
+                )
 
-        if resp.status < 200 or resp.status >= 300:
-            raise RequestError(
-                resp.status,
-                f"Failed to get response from '{resp.geturl()}':\n{resp.data}",
-            )
+            try:
+                resp = send_once(self, fn, labels, level, method, args, kwargs)
+            except RequestError as e:
+                if e.transient and e.status != 429:
+                    breaker.failure()
+                else:
+                    # Rate limits and client errors mean it's up.
+                    breaker.success()
 
-        return {} if resp.status == 204 else json.loads(resp.data)
+                if attempt == retries or not RETRY.retryable(
+                    method, e.status, e.unsent
+                ):
+                    raise
+
+                metrics.REQUEST_RETRIES.inc(**labels)
+                time.sleep(RETRY.delay(attempt, e.retry_after))
+                continue
+
+            breaker.success()
+
+            return resp
 
     return wrapper
 
 
+def send_once(self, fn, labels, level, method, args, kwargs):
+    scheduler = SCHEDULERS[self.destination]
+
+    # Wait for our turn, low priority requests may be dropped instead.
+    if not scheduler.acquire(level):
+        return {}
+
+    start = time.perf_counter()
+
+    try:
+        resp = fn(self, method, *args, **kwargs)
+    except urllib3.exceptions.HTTPError as e:
+        metrics.REQUEST_ERRORS.inc(status="none", **labels)
+        error = RequestError(None, f"Failed to connect: {e}")
+        error.unsent = unsent(e)
+
+        raise error from None
+    finally:
+        scheduler.release()
+        metrics.REQUEST_LATENCY.observe(time.perf_counter() - start, **labels)
+
+    if resp.status < 200 or resp.status >= 300:
+        metrics.REQUEST_ERRORS.inc(status=resp.status, **labels)
+        error = RequestError(
+            resp.status,
+            f"Failed to get response from '{resp.geturl()}':\n{resp.data}",
+        )
+        error.retry_after = retry_after(resp.status, resp.headers, resp.data)
+
+        raise error
+
+    return {} if resp.status == 204 else json.loads(resp.data)
+
+
+def unsent(error: urllib3.exceptions.HTTPError) -> bool:
+    """
+    Whether a request failed while connecting, before anything was sent.
+    """
+
+    if isinstance(error, urllib3.exceptions.MaxRetryError):
+        error = error.reason
+
+    return isinstance(
+        error,
+        (
+            urllib3.exceptions.ConnectTimeoutError,
+            urllib3.exceptions.NewConnectionError,
+        ),
+    )
+
+
+def retry_after(status: int, headers: Mapping[str, str], data: bytes) -> float:
+    """
+    Get the number of seconds to wait before retrying a rate limited request.
+    """
+
+    if status != 429:
+        return 0
+
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, ValueError):
+        pass
+
+    # Matrix only includes it in the body.
+    try:
+        return json.loads(data).get("retry_after_ms", 0) / 1000
+    except (ValueError, AttributeError):
+        return 0
+
+
 def except_deleted(fn):
     """
     Ignore the `RequestError` on 404s, the content might have been removed.
@@ -0,0 +1,138 @@
+import functools
+import threading
+import time
+from typing import Dict
+
+import urllib3
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import discord
+import metrics
+
+# Connections per host and timeout in seconds, downloads can take a while.
+DEFAULTS = {
+    "homeserver": {"maxsize": 10, "timeout": 30},
+    "discord": {"maxsize": 10, "timeout": 30},
+    "cdn": {"maxsize": 4, "timeout": 60},
+    "media": {"maxsize": 4, "timeout": 60},
+}
+
+CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+# Seconds to wait for a connection to be established.
+CONNECT_TIMEOUT = 10
+
+
+class Usage:
+    """
+    Connections of a destination that are in use, across all of it's hosts.
+    """
+
+    def __init__(self, destination: str) -> None:
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.in_use = 0
+
+    def add(self, amount: int) -> None:
+        with self.lock:
+            self.in_use += amount
+
+            metrics.POOL_IN_USE.set(self.in_use, destination=self.destination)
+
+
+class InstrumentedPool:
+    """
+    Record how long requests wait for a connection and whether it was
+    reused, mixed into urllib3's connection pools.
+    """
+
+    def __init__(self, *args, usage: Usage, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        self.usage = usage
+
+    def _get_conn(self, timeout: float = None):
+        start = time.perf_counter()
+        conn = super()._get_conn(timeout)
+
+        metrics.POOL_WAIT.observe(
+            time.perf_counter() - start, destination=self.usage.destination
+        )
+
+        # New and dropped connections aren't connected yet.
+        metrics.POOL_CONNECTIONS.inc(
+            destination=self.usage.destination,
+            reused=str(conn.sock is not None).lower(),
+        )
+        self.usage.add(1)
+
+        return conn
+
+    def _put_conn(self, conn) -> None:
+        self.usage.add(-1)
+
+        super()._put_conn(conn)
+
+
+class InstrumentedHTTPPool(InstrumentedPool, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSPool(InstrumentedPool, HTTPSConnectionPool):
+    pass
+
+
+class Pools:
+    """
+    A separate pool manager for every kind of destination, so that slow
+    downloads can't use up the connections needed to bridge messages.
+    `config` overrides the `DEFAULTS` of each destination.
+    """
+
+    def __init__(self, config: dict = {}) -> None:
+        self.managers: Dict[str, urllib3.PoolManager] = {}
+        self.maxsize: Dict[str, int] = {}
+
+        for destination, defaults in DEFAULTS.items():
+            options = {**defaults, **config.get(destination, {})}
+            maxsize = int(options["maxsize"])
+            timeout = float(options["timeout"])
+
+            # Blocking, so that a destination never uses more than `maxsize`
+            # connections to a host.
+            manager = urllib3.PoolManager(
+                maxsize=maxsize,
+                block=True,
+                timeout=urllib3.Timeout(
+                    connect=min(timeout, CONNECT_TIMEOUT), read=timeout
+                ),
+            )
+
+            usage = Usage(destination)
+            manager.pool_classes_by_scheme = {
+                "http": functools.partial(InstrumentedHTTPPool, usage=usage),
+                "https": functools.partial(InstrumentedHTTPSPool, usage=usage),
+            }
+
+            metrics.POOL_SIZE.set(maxsize, destination=destination)
+
+            self.managers[destination] = manager
+            self.maxsize[destination] = maxsize
+
+    def __getitem__(self, destination: str) -> urllib3.PoolManager:
+        return self.managers[destination]
+
+    def for_url(self, url: str) -> urllib3.PoolManager:
+        """
+        Get the pool manager for downloading a file.
+        """
+
+        cdn = url.startswith(discord.CDN_URL) or (
+            urllib3.util.parse_url(url).host in CDN_HOSTS
+        )
+
+        return self.managers["cdn" if cdn else "media"]
+
+    def clear(self) -> None:
+        for manager in self.managers.values():
+            manager.clear()
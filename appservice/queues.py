@@ -0,0 +1,71 @@
+import queue
+from typing import Any, Dict
+
+# All the queues by name, for reporting.
+QUEUES: Dict[str, "BoundedQueue"] = {}
+
+
+class Full(Exception):
+    """
+    Raised when an item couldn't be queued within the timeout.
+    """
+
+
+class BoundedQueue:
+    """
+    A named queue holding at most `maxsize` items. Once `high_water` items are
+    queued, droppable items are shed while the rest wait for free space.
+
+    `backend` can be any object with the interface of `queue.Queue`, such as
+    a `multiprocessing.Queue` created with the same `maxsize`.
+    """
+
+    def __init__(
+        self, name: str, maxsize: int, high_water: int, backend: Any = None
+    ) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.high_water = min(high_water, maxsize)
+        self.queue = backend if backend is not None else queue.Queue(maxsize)
+
+        self.shed = self.rejected = 0
+
+        QUEUES[name] = self
+
+    def __len__(self) -> int:
+        return self.queue.qsize()
+
+    def put(
+        self, item: Any, droppable: bool = False, timeout: float = None
+    ) -> bool:
+        """
+        Queue an item, waiting at most `timeout` seconds for free space.
+        Returns `False` if a droppable item was shed and raises `Full` if
+        there was no space in time.
+        """
+
+        if droppable and self.queue.qsize() >= self.high_water:
+            self.shed += 1
+            return False
+
+        try:
+            self.queue.put(item, timeout=timeout)
+        except queue.Full:
+            self.rejected += 1
+            raise Full(f"Queue '{self.name}' is full.") from None
+
+        return True
+
+    def get(self, timeout: float = None) -> Any:
+        return self.queue.get(timeout=timeout)
+
+    def get_nowait(self) -> Any:
+        return self.queue.get_nowait()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.queue.qsize(),
+            "maxsize": self.maxsize,
+            "shed": self.shed,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,209 @@
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+import metrics
+from journal import Journal, read
+
+# Statuses that are worth retrying. The request may have been handled for
+# all of them except 429, so they're only retried if it can be repeated.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff, the n-th retry waits for a random duration
+    of up to `base * 2 ** n` seconds, capped at `cap`.
+    """
+
+    def __init__(
+        self, max_retries: int = 3, base: float = 0.5, cap: float = 30
+    ) -> None:
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+
+    def retryable(self, method: str, status: int, unsent: bool) -> bool:
+        """
+        Whether a failed request is worth repeating, `status` is `None` if
+        there was no response and `unsent` if there was no connection.
+        Requests that may have been handled are only repeated if that's
+        safe, so that messages aren't duplicated.
+        """
+
+        # Rate limited and unsent requests weren't handled.
+        if unsent or status == 429:
+            return True
+
+        return method in IDEMPOTENT_METHODS and (
+            status is None or status in RETRY_STATUSES
+        )
+
+    def delay(self, attempt: int, retry_after: float = 0) -> float:
+        # Rate limits tell us exactly how long to wait.
+        if retry_after:
+            return min(retry_after, self.cap)
+
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+
+class CircuitBreaker:
+    """
+    Fail fast once `threshold` consecutive requests to a destination failed,
+    a single trial request is let through every `reset_timeout` seconds
+    until one succeeds.
+    """
+
+    def __init__(
+        self, name: str, threshold: int = 5, reset_timeout: float = 30
+    ) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+
+        metrics.CIRCUIT_STATE.set(CLOSED, destination=name)
+
+        # Called without the lock held when the destination recovers.
+        self.on_recover: List[Callable[[str], None]] = []
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+
+            if (
+                self.state == OPEN
+                and time.monotonic() - self.opened >= self.reset_timeout
+            ):
+                self.state = HALF_OPEN
+                metrics.CIRCUIT_STATE.set(HALF_OPEN, destination=self.name)
+                return True
+
+            return False
+
+    def success(self) -> None:
+        with self.lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+
+            metrics.CIRCUIT_STATE.set(CLOSED, destination=self.name)
+
+        if recovered:
+            for callback in self.on_recover:
+                callback(self.name)
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self.opened = time.monotonic()
+
+                metrics.CIRCUIT_STATE.set(OPEN, destination=self.name)
+
+
+RETRY = RetryPolicy()
+BREAKERS: Dict[str, CircuitBreaker] = {
+    "homeserver": CircuitBreaker("homeserver"),
+    "discord": CircuitBreaker("discord"),
+}
+
+
+def configure(max_retries: int, threshold: int, reset_timeout: float) -> None:
+    RETRY.max_retries = max_retries
+
+    for breaker in BREAKERS.values():
+        breaker.threshold = threshold
+        breaker.reset_timeout = reset_timeout
+
+
+class DeadLetters:
+    """
+    Events that couldn't be bridged as a destination was unavailable, they
+    are persisted and replayed once all the destinations are available.
+    """
+
+    def __init__(self, logger) -> None:
+        self.logger = logger
+        self.journal: Journal = None
+        self.recovered = threading.Event()
+
+        for breaker in BREAKERS.values():
+            breaker.on_recover.append(lambda _: self.recovered.set())
+
+    def open(self, path: str) -> None:
+        self.journal = Journal(path)
+
+        # Left over from the last run, possibly in the middle of a replay.
+        if os.path.exists(path) or os.path.exists(self.replaying):
+            self.recovered.set()
+
+    @property
+    def replaying(self) -> str:
+        return f"{self.journal.path}.replay"
+
+    def add(self, item: dict, error: Exception) -> None:
+        if not self.journal:
+            self.logger.warning(f"Dropping event that failed with: {error}")
+            return
+
+        self.logger.warning(f"Dead-lettering event that failed with: {error}")
+
+        self.journal.append(item)
+        metrics.DEAD_LETTERS.inc()
+
+    def run(self, dispatch: Callable[[dict], None], interval: float = 60):
+        """
+        Replay the dead letters whenever a destination recovers, or every
+        `interval` seconds in-case none of them were used in the meantime.
+        """
+
+        while True:
+            self.recovered.wait(interval)
+            self.recovered.clear()
+
+            if not self.journal:
+                continue
+
+            if any(breaker.state != CLOSED for breaker in BREAKERS.values()):
+                continue
+
+            # Events that fail again are added to a new file. A replay that
+            # was interrupted is finished first.
+            interrupted = os.path.exists(self.replaying)
+
+            if not interrupted:
+                with self.journal.lock:
+                    if not os.path.exists(self.journal.path):
+                        continue
+
+                    os.replace(self.journal.path, self.replaying)
+
+            items = read(self.replaying)
+
+            self.logger.info(f"Replaying {len(items)} dead-lettered events.")
+
+            for item in items:
+                dispatch(item)
+
+            # Only once they were all handled, so that none are lost if
+            # we're stopped in the middle of it.
+            os.remove(self.replaying)
+
+            metrics.DEAD_LETTERS_REPLAYED.inc(len(items))
+
+            # The new file may have events too.
+            if interrupted:
+                self.recovered.set()
@@ -0,0 +1,129 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Tuple
+
+# Priority classes for outgoing requests, lower values are served first.
+MESSAGE = 0
+EDIT = 1  # Edits and redactions.
+PROFILE = 2  # Profile syncs and media uploads.
+TYPING = 3  # Dropped instead of waiting for a free slot.
+
+NAMES = {
+    MESSAGE: "message",
+    EDIT: "edit",
+    PROFILE: "profile",
+    TYPING: "typing",
+}
+
+# The priority of the requests made in the current context.
+PRIORITY: contextvars.ContextVar = contextvars.ContextVar(
+    "priority", default=MESSAGE
+)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    """
+    Set the priority of the requests made in a `with` block, or in a function
+    when used as a decorator.
+    """
+
+    token = PRIORITY.set(level)
+
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+class Scheduler:
+    """
+    Limit the number of concurrent outgoing requests to `slots`, requests
+    waiting for a free slot are served in the order of their priority.
+    """
+
+    def __init__(self, slots: int = 10) -> None:
+        self.slots = self.free = slots
+
+        self.lock = threading.Lock()
+        self.waiting: List[Tuple[int, int, threading.Event]] = []
+        self.counter = itertools.count()  # FIFO order within a class.
+
+        self.depth = {level: 0 for level in NAMES}
+        self.dropped = {level: 0 for level in NAMES}
+
+    def configure(self, slots: int) -> None:
+        with self.lock:
+            self.free += slots - self.slots
+            self.slots = slots
+
+            while self.free > 0 and self.waiting:
+                self.free -= 1
+                self.wake()
+
+    def acquire(self, level: int) -> bool:
+        """
+        Wait for a free slot, returns `False` if the request was dropped.
+        """
+
+        with self.lock:
+            if self.free > 0 and not self.waiting:
+                self.free -= 1
+                return True
+
+            if level >= TYPING:
+                self.dropped[level] += 1
+                return False
+
+            event = threading.Event()
+            heapq.heappush(self.waiting, (level, next(self.counter), event))
+            self.depth[level] += 1
+
+        # The slot is handed over directly by `release`.
+        event.wait()
+
+        return True
+
+    def release(self) -> None:
+        with self.lock:
+            # Slots that were removed by `configure` aren't handed over.
+            if self.waiting and self.free >= 0:
+                self.wake()
+            else:
+                self.free += 1
+
+    def wake(self) -> None:
+        """
+        Hand a slot over to the highest priority waiter, the caller must hold
+        `self.lock`.
+        """
+
+        level, _, event = heapq.heappop(self.waiting)
+        self.depth[level] -= 1
+        event.set()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {
+                "depth": {NAMES[k]: v for k, v in self.depth.items()},
+                "dropped": {NAMES[k]: v for k, v in self.dropped.items()},
+            }
+
+
+# One for every destination, sized to it's connection pool so that a busy
+# destination can't hold up the requests to the other.
+SCHEDULERS = {
+    destination: Scheduler() for destination in ("homeserver", "discord")
+}
+
+
+def configure(slots: Dict[str, int]) -> None:
+    """
+    Set the number of slots of every destination's scheduler.
+    """
+
+    for destination, scheduler in SCHEDULERS.items():
+        scheduler.configure(slots[destination])
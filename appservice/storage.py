@@ -0,0 +1,320 @@
+import abc
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import metrics
+
+# Older SQLite versions limit queries to 999 bound parameters.
+MAX_PARAMS = 500
+
+
+class Storage(abc.ABC):
+    """
+    The interface implemented by all the storage engines, engines must be
+    safe to use from multiple threads.
+    """
+
+    @abc.abstractmethod
+    def add_room(self, room_id: str, channel_id: str) -> None: ...
+
+    @abc.abstractmethod
+    def list_rooms(self) -> Dict[str, str]: ...
+
+    @abc.abstractmethod
+    def add_user(self, mxid: str) -> None: ...
+
+    @abc.abstractmethod
+    def update_user(self, mxid: str, key: str, value: str) -> None: ...
+
+    @abc.abstractmethod
+    def fetch_user(self, mxid: str) -> dict: ...
+
+    @abc.abstractmethod
+    def fetch_users(self, mxids: List[str] = None) -> Dict[str, dict]:
+        """
+        Fetch the profiles for the given users in a single query, or all the
+        users if `mxids` is `None`. Unknown users are left out.
+        """
+
+    @abc.abstractmethod
+    def add_webhook(
+        self, channel_id: str, webhook_id: str, token: str
+    ) -> None: ...
+
+    @abc.abstractmethod
+    def list_webhooks(self) -> Dict[str, dict]: ...
+
+    @abc.abstractmethod
+    def add_emote(self, name: str, mxc_url: str) -> None: ...
+
+    @abc.abstractmethod
+    def list_emotes(self) -> Dict[str, str]: ...
+
+    @abc.abstractmethod
+    def touch_room(self, room_id: str, timestamp: int) -> None: ...
+
+    @abc.abstractmethod
+    def list_active_rooms(self, limit: int) -> List[str]:
+        """
+        Get the most recently active rooms, most recent first.
+        """
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_file: str) -> None:
+        self.create(db_file)
+
+        # The database is accessed via multiple threads.
+        self.lock = threading.Lock()
+
+    def create(self, db_file: str) -> None:
+        """
+        Create a database with the relevant tables if it doesn't already exist.
+        """
+
+        exists = os.path.exists(db_file)
+
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.row_factory = self.dict_factory
+
+        self.cur = self.conn.cursor()
+
+        if not exists:
+            self.cur.execute(
+                "CREATE TABLE bridge(room_id TEXT PRIMARY KEY, "
+                "channel_id TEXT);"
+            )
+
+            self.cur.execute(
+                "CREATE TABLE users(mxid TEXT PRIMARY KEY, "
+                "avatar_url TEXT, username TEXT);"
+            )
+
+        # Tables added later on are also created for existing databases.
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS webhooks(channel_id TEXT PRIMARY KEY, "
+            "webhook_id TEXT, token TEXT);"
+        )
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS emotes(name TEXT PRIMARY KEY, "
+            "mxc_url TEXT);"
+        )
+        self.cur.execute(
+            "CREATE TABLE IF NOT EXISTS activity(room_id TEXT PRIMARY KEY, "
+            "timestamp INTEGER);"
+        )
+
+        self.conn.commit()
+
+    def dict_factory(self, cursor, row):
+        """
+        https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.row_factory
+        """
+
+        d = {}
+        for idx, col in enumerate(cursor.description):
+            d[col[0]] = row[idx]
+        return d
+
+    def acquire(self) -> None:
+        start = time.perf_counter()
+
+        self.lock.acquire()
+
+        metrics.DB_LOCK_WAIT.observe(time.perf_counter() - start)
+
+    def execute(self, query: str, args: list = []) -> None:
+        self.acquire()
+
+        try:
+            with metrics.DB_QUERY.time(engine="sqlite"):
+                self.cur.execute(query, args)
+                self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def fetch(self, query: str, args: list = []) -> List[dict]:
+        self.acquire()
+
+        try:
+            with metrics.DB_QUERY.time(engine="sqlite"):
+                self.cur.execute(query, args)
+
+                return self.cur.fetchall()
+        finally:
+            self.lock.release()
+
+    def add_room(self, room_id: str, channel_id: str) -> None:
+        self.execute(
+            "INSERT INTO bridge (room_id, channel_id) VALUES (?, ?)",
+            [room_id, channel_id],
+        )
+
+    def list_rooms(self) -> Dict[str, str]:
+        rooms = self.fetch("SELECT * FROM bridge")
+
+        return {room["room_id"]: room["channel_id"] for room in rooms}
+
+    def add_user(self, mxid: str) -> None:
+        # Workers may register the same user concurrently.
+        self.execute("INSERT OR IGNORE INTO users (mxid) VALUES (?)", [mxid])
+
+    def update_user(self, mxid: str, key: str, value: str) -> None:
+        # `key` is one of our own column names, never user input.
+        self.execute(
+            f"UPDATE users SET {key} = (?) WHERE mxid = (?)", [value, mxid]
+        )
+
+    def fetch_user(self, mxid: str) -> dict:
+        user = self.fetch("SELECT * FROM users where mxid = ?", [mxid])
+
+        return user[0] if user else {}
+
+    def fetch_users(self, mxids: List[str] = None) -> Dict[str, dict]:
+        if mxids is None:
+            users = self.fetch("SELECT * FROM users")
+        else:
+            users = []
+
+            # Stay below SQLite's limit on the number of bound parameters.
+            for idx in range(0, len(mxids), MAX_PARAMS):
+                chunk = mxids[idx : idx + MAX_PARAMS]
+                users.extend(
+                    self.fetch(
+                        "SELECT * FROM users WHERE mxid IN "
+                        f"({', '.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+
+        return {user["mxid"]: user for user in users}
+
+    def add_webhook(
+        self, channel_id: str, webhook_id: str, token: str
+    ) -> None:
+        self.execute(
+            "INSERT OR REPLACE INTO webhooks (channel_id, webhook_id, token) "
+            "VALUES (?, ?, ?)",
+            [channel_id, webhook_id, token],
+        )
+
+    def list_webhooks(self) -> Dict[str, dict]:
+        webhooks = self.fetch("SELECT * FROM webhooks")
+
+        return {webhook["channel_id"]: webhook for webhook in webhooks}
+
+    def add_emote(self, name: str, mxc_url: str) -> None:
+        self.execute(
+            "INSERT OR REPLACE INTO emotes (name, mxc_url) VALUES (?, ?)",
+            [name, mxc_url],
+        )
+
+    def list_emotes(self) -> Dict[str, str]:
+        emotes = self.fetch("SELECT * FROM emotes")
+
+        return {emote["name"]: emote["mxc_url"] for emote in emotes}
+
+    def touch_room(self, room_id: str, timestamp: int) -> None:
+        self.execute(
+            "INSERT OR REPLACE INTO activity (room_id, timestamp) "
+            "VALUES (?, ?)",
+            [room_id, timestamp],
+        )
+
+    def list_active_rooms(self, limit: int) -> List[str]:
+        rooms = self.fetch(
+            "SELECT room_id FROM activity ORDER BY timestamp DESC LIMIT ?",
+            [limit],
+        )
+
+        return [room["room_id"] for room in rooms]
+
+
+class MemoryStorage(Storage):
+    """
+    Keep everything in memory, nothing is persisted across restarts. This is
+    mostly useful for benchmarking the bridge without any storage overhead.
+    """
+
+    def __init__(self, db_file: str = "") -> None:
+        self.lock = threading.Lock()
+        self.rooms = {}  # room_id: channel_id
+        self.users = {}  # mxid: profile
+        self.webhooks = {}  # channel_id: webhook
+        self.emotes = {}  # name: mxc_url
+        self.activity = {}  # room_id: timestamp
+
+    def add_room(self, room_id: str, channel_id: str) -> None:
+        with self.lock:
+            self.rooms[room_id] = channel_id
+
+    def list_rooms(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.rooms)
+
+    def add_user(self, mxid: str) -> None:
+        with self.lock:
+            self.users.setdefault(
+                mxid, {"mxid": mxid, "avatar_url": None, "username": None}
+            )
+
+    def update_user(self, mxid: str, key: str, value: str) -> None:
+        with self.lock:
+            if mxid in self.users:
+                self.users[mxid][key] = value
+
+    def fetch_user(self, mxid: str) -> dict:
+        with self.lock:
+            return dict(self.users.get(mxid, {}))
+
+    def fetch_users(self, mxids: List[str] = None) -> Dict[str, dict]:
+        with self.lock:
+            if mxids is None:
+                return {k: dict(v) for k, v in self.users.items()}
+
+            return {
+                mxid: dict(self.users[mxid])
+                for mxid in mxids
+                if mxid in self.users
+            }
+
+    def add_webhook(
+        self, channel_id: str, webhook_id: str, token: str
+    ) -> None:
+        with self.lock:
+            self.webhooks[channel_id] = {
+                "channel_id": channel_id,
+                "webhook_id": webhook_id,
+                "token": token,
+            }
+
+    def list_webhooks(self) -> Dict[str, dict]:
+        with self.lock:
+            return {k: dict(v) for k, v in self.webhooks.items()}
+
+    def add_emote(self, name: str, mxc_url: str) -> None:
+        with self.lock:
+            self.emotes[name] = mxc_url
+
+    def list_emotes(self) -> Dict[str, str]:
+        with self.lock:
+            return dict(self.emotes)
+
+    def touch_room(self, room_id: str, timestamp: int) -> None:
+        with self.lock:
+            self.activity[room_id] = timestamp
+
+    def list_active_rooms(self, limit: int) -> List[str]:
+        with self.lock:
+            rooms = sorted(self.activity, key=self.activity.get, reverse=True)
+
+        return rooms[:limit]
+
+
+ENGINES = {
+    "sqlite": SQLiteStorage,
+    "memory": MemoryStorage,
+}
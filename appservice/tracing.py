@@ -0,0 +1,185 @@
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Callable, List, Tuple
+
+import metrics
+
+# Traces taking at least this many seconds are logged, `0` disables it.
+SLOW_THRESHOLD = 0.0
+
+# The event types that the histograms are labelled with, the rest are
+# aggregated as "other" so that the number of series stays bounded.
+EVENTS = (
+    "m.room.member",
+    "m.room.message",
+    "m.room.redaction",
+    "MESSAGE_CREATE",
+    "MESSAGE_UPDATE",
+    "MESSAGE_DELETE",
+    "TYPING_START",
+    "GUILD_CREATE",
+    "GUILD_MEMBER_UPDATE",
+    "GUILD_EMOJIS_UPDATE",
+)
+
+logger = logging.getLogger("tracing")
+
+
+class Trace:
+    """
+    The time spent in each stage of bridging a single event, along with
+    tags such as the channel and room that it was bridged between. Only the
+    event type is used as a label, the rest are only logged.
+    """
+
+    def __init__(self, pipeline: str, since: float = None) -> None:
+        self.pipeline = pipeline
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []  # (stage, seconds)
+        self.tags = {"event": "", "channel": "", "room": ""}
+        self.handed_off = False
+
+        # Time spent between receiving the event and starting to handle it.
+        if since is not None:
+            self.spans.append(("receive", self.start - since))
+            self.start = since
+
+    def finish(self) -> None:
+        # The worker that the event was handed off to reports the trace.
+        if self.handed_off:
+            return
+
+        total = time.perf_counter() - self.start
+        event = self.tags["event"] if self.tags["event"] in EVENTS else "other"
+
+        REPORT(self.pipeline, event, self.spans, total)
+
+        if SLOW_THRESHOLD and total >= SLOW_THRESHOLD:
+            logger.warning(f"Slow {self.describe(total)}")
+
+    def describe(self, total: float) -> str:
+        tags = " ".join(f"{k}={v}" for k, v in self.tags.items() if v)
+        stages = ", ".join(
+            f"{stage} {seconds * 1000:.1f}ms" for stage, seconds in self.spans
+        )
+        untraced = total - sum(seconds for _, seconds in self.spans)
+
+        return (
+            f"{self.pipeline} event ({tags}) took {total * 1000:.1f}ms: "
+            f"{stages}, untraced {untraced * 1000:.1f}ms"
+        )
+
+
+def observe(
+    pipeline: str, event: str, spans: List[Tuple[str, float]], total: float
+) -> None:
+    """
+    Record a finished trace in the histograms.
+    """
+
+    for stage, seconds in spans:
+        metrics.STAGE_LATENCY.observe(
+            seconds, pipeline=pipeline, stage=stage, event=event
+        )
+
+    metrics.TRACE_LATENCY.observe(total, pipeline=pipeline, event=event)
+
+
+# The trace of the event being bridged in the current context.
+TRACE: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+# Called with every finished trace, workers send them to the ingress process
+# which serves the metrics.
+REPORT: Callable[[str, str, List[Tuple[str, float]], float], None] = observe
+
+
+def configure(slow_threshold: float) -> None:
+    global SLOW_THRESHOLD
+
+    SLOW_THRESHOLD = slow_threshold
+
+
+def received() -> float:
+    """
+    Get the `time.time()` at which the event of the current trace was
+    received, or now outside of a trace. Unlike `time.perf_counter()` it's
+    comparable across processes.
+    """
+
+    current = TRACE.get()
+    now = time.time()
+
+    return now - (time.perf_counter() - current.start) if current else now
+
+
+def since(timestamp: float) -> float:
+    """
+    Convert a timestamp from `received()` to a `time.perf_counter()`.
+    """
+
+    return time.perf_counter() - max(time.time() - timestamp, 0)
+
+
+@contextlib.contextmanager
+def trace(pipeline: str, since: float = None):
+    """
+    Trace the event that is bridged in a `with` block, the spans are
+    aggregated once it's done. `since` is the `time.perf_counter()` at which
+    the event was received.
+    """
+
+    current = Trace(pipeline, since)
+    token = TRACE.set(current)
+
+    try:
+        yield current
+    finally:
+        TRACE.reset(token)
+        current.finish()
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """
+    Time a stage of the current trace, in a `with` block or in a function
+    when used as a decorator. Does nothing outside of a trace.
+    """
+
+    current = TRACE.get()
+
+    if not current:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        current.spans.append((stage, time.perf_counter() - start))
+
+
+def hand_off() -> None:
+    """
+    Leave the current trace, if any, to the worker that the event was routed
+    to. The worker's trace starts from when the event was received, so it
+    already covers the time spent here.
+    """
+
+    current = TRACE.get()
+
+    if current:
+        current.handed_off = True
+
+
+def tag(**tags: str) -> None:
+    """
+    Tag the current trace, if any.
+    """
+
+    current = TRACE.get()
+
+    if current:
+        current.tags.update(tags)
@@ -0,0 +1,384 @@
+import functools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from typing import Dict, List
+
+import tracing
+from journal import Journal
+from misc import hash_str
+from queues import BoundedQueue, Full
+
+# Events that are handled by the worker which owns the channel.
+DISCORD_EVENTS = (
+    "MESSAGE_CREATE",
+    "MESSAGE_UPDATE",
+    "MESSAGE_DELETE",
+    "TYPING_START",
+)
+MATRIX_EVENTS = ("m.room.member", "m.room.message", "m.room.redaction")
+
+# Seconds to wait for the workers to journal their queues after the drain
+# deadline has passed.
+JOURNAL_TIMEOUT = 5
+
+# Seconds between checking whether the workers are still alive.
+SUPERVISE_INTERVAL = 1
+
+# Finished traces that the workers can send before the ingress process has
+# recorded them, the rest are dropped.
+TRACES_SIZE = 10000
+
+
+def partition(channel_id: str, workers: int) -> int:
+    """
+    Get the worker that owns a channel, `hash()` isn't used as it differs
+    between processes.
+    """
+
+    return hash_str(channel_id) % workers
+
+
+class Router:
+    """
+    Forward events from the ingress process to the worker processes, every
+    channel along with it's bridged room is owned by a single worker so that
+    the messages in it are handled in order.
+
+    Queue items are plain JSON-serialisable dicts:
+    `{"source": "matrix", "event": {...}}`,
+    `{"source": "discord", "type": "MESSAGE_CREATE", "data": {...}}`
+    or control items such as `{"source": "control", "op": "rooms"}`.
+    Forwarded events also carry the `tracing.received()` time as
+    `"received"`, so that the time spent in the queue is traced.
+    """
+
+    def __init__(self, basedir: str, config: dict, workers: int) -> None:
+        self.db = None  # The ingress process' database.
+        self.logger = logging.getLogger("router")
+
+        self.basedir = basedir
+        self.config = config
+
+        # Workers are spawned so that they don't inherit our threads or
+        # database connections.
+        self.ctx = ctx = multiprocessing.get_context("spawn")
+
+        # Set once the workers should journal events instead of handling them.
+        self.expired = ctx.Event()
+
+        # Set once we're stopping, so that workers aren't restarted anymore.
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+        # Typing notifications are shed once a queue reaches it's high-water
+        # mark, the rest are rejected if there's no space in time. Rejected
+        # transactions are retried by the homeserver, and Discord events are
+        # dead-lettered.
+        maxsize = int(config.get("queue_size", 1000))
+        high_water = int(config.get("queue_high_water", 800))
+        self.timeout = float(config.get("queue_timeout", 10))
+
+        # The workers' traces, recorded by us as they don't serve metrics.
+        self.traces = ctx.Queue(TRACES_SIZE)
+
+        self.queues: List[BoundedQueue] = [
+            BoundedQueue(
+                f"worker-{idx}", maxsize, high_water, ctx.Queue(maxsize)
+            )
+            for idx in range(workers)
+        ]
+        self.processes = [self.spawn(idx) for idx in range(workers)]
+
+    def spawn(self, idx: int) -> multiprocessing.Process:
+        return self.ctx.Process(
+            target=run_worker,
+            args=(
+                idx,
+                self.basedir,
+                self.config,
+                self.queues[idx].queue,
+                self.traces,
+                self.expired,
+            ),
+            name=f"worker-{idx}",
+            daemon=True,
+        )
+
+    def start(self, db) -> None:
+        self.db = db
+
+        for process in self.processes:
+            process.start()
+
+        threading.Thread(target=self.collect_traces, daemon=True).start()
+        threading.Thread(target=self.supervise, daemon=True).start()
+
+        self.logger.info(f"Started {len(self.processes)} workers.")
+
+    def supervise(self) -> None:
+        """
+        Restart the workers that died. A dead worker may hold it's queue's
+        read lock forever, so the replacement gets a new queue and the events
+        left in the old one are lost.
+        """
+
+        while not self.stopping.wait(SUPERVISE_INTERVAL):
+            with self.lock:
+                if self.stopping.is_set():
+                    return
+
+                for idx, process in enumerate(self.processes):
+                    if process.is_alive():
+                        continue
+
+                    old = self.queues[idx].queue
+                    self.queues[idx].queue = self.ctx.Queue(
+                        self.queues[idx].maxsize
+                    )
+
+                    self.logger.error(
+                        f"'{process.name}' died with exit code "
+                        f"{process.exitcode}, restarting it and dropping "
+                        f"{old.qsize()} queued events."
+                    )
+
+                    # Nobody reads it anymore, so we mustn't wait for it to
+                    # be flushed when exiting.
+                    old.cancel_join_thread()
+                    old.close()
+
+                    self.processes[idx] = self.spawn(idx)
+                    self.processes[idx].start()
+
+    def collect_traces(self) -> None:
+        while True:
+            tracing.observe(*self.traces.get())
+
+    def put(
+        self,
+        channel_id: str,
+        item: dict,
+        droppable: bool = False,
+        timeout: float = None,
+    ) -> bool:
+        return self.queues[partition(channel_id, len(self.queues))].put(
+            item, droppable, timeout
+        )
+
+    def broadcast(self, item: dict) -> None:
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put(item, timeout=self.timeout)
+            except Full:
+                self.logger.warning(
+                    f"Dropped '{item.get('op') or item.get('type')}' for "
+                    f"'{worker_queue.name}', it's queue is full."
+                )
+
+    def route_matrix(self, event: dict) -> bool:
+        """
+        Forward an event for a bridged room to it's worker, returns `False`
+        if the event should be handled by the ingress process instead.
+        Raises `queues.Full` if the worker's queue stays full for too long.
+        """
+
+        if event.get("type") not in MATRIX_EVENTS:
+            return False
+
+        channel_id = self.db.get_channel(event.get("room_id", ""))
+
+        # Bridging commands and direct messages are handled by us.
+        if not channel_id:
+            return False
+
+        self.put(
+            channel_id,
+            {
+                "source": "matrix",
+                "event": event,
+                "received": tracing.received(),
+            },
+            timeout=self.timeout,
+        )
+
+        return True
+
+    def route_discord(self, data: dict, otype: str) -> bool:
+        """
+        Forward a dispatch event to the worker that owns it's channel,
+        returns `False` if the event should be handled by the ingress
+        process instead. Raises `queues.Full` if the worker's queue stays
+        full for too long.
+        """
+
+        item = {
+            "source": "discord",
+            "type": otype,
+            "data": data,
+            "received": tracing.received(),
+        }
+
+        if otype in DISCORD_EVENTS:
+            self.put(
+                data["channel_id"],
+                item,
+                droppable=otype == "TYPING_START",
+                timeout=self.timeout,
+            )
+            return True
+
+        # Every worker needs the emotes, but profiles are only synced and
+        # the guilds' emotes are only uploaded by us. Workers only upload
+        # the ones that they need before we sent them. They're traced by us
+        # instead of by every worker.
+        if otype == "GUILD_EMOJIS_UPDATE":
+            self.broadcast({"source": "discord", "type": otype, "data": data})
+        elif otype == "GUILD_CREATE":
+            self.broadcast(
+                {
+                    "source": "discord",
+                    "type": "GUILD_EMOJIS_UPDATE",
+                    "data": {"guild_id": data["id"], "emojis": data["emojis"]},
+                }
+            )
+
+        return False
+
+    def rooms_changed(self) -> None:
+        """
+        Make the workers reload the bridged rooms from the database.
+        """
+
+        self.broadcast({"source": "control", "op": "rooms"})
+
+    def emotes_changed(self, emotes: Dict[str, str]) -> None:
+        """
+        Send the emotes uploaded by the ingress process to the workers.
+        """
+
+        self.broadcast({"source": "control", "op": "emotes", "emotes": emotes})
+
+    def stop(self, deadline: float) -> None:
+        """
+        Let the workers drain their queues until `deadline`, a
+        `time.monotonic()` timestamp. The events that are left are journaled
+        by the workers.
+        """
+
+        with self.lock:
+            self.stopping.set()
+
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put(
+                    {"source": "control", "op": "stop"},
+                    timeout=max(deadline - time.monotonic(), 0),
+                )
+            except Full:
+                # Journaling frees up space quickly, unless it's stuck.
+                self.expired.set()
+
+                try:
+                    worker_queue.put(
+                        {"source": "control", "op": "stop"},
+                        timeout=JOURNAL_TIMEOUT,
+                    )
+                except Full:
+                    self.logger.warning(f"'{worker_queue.name}' is stuck.")
+
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+
+        self.expired.set()
+
+        for process in self.processes:
+            process.join(JOURNAL_TIMEOUT)
+
+            if process.is_alive():
+                self.logger.warning(f"Killing '{process.name}'.")
+                process.terminate()
+
+
+def dispatch(app, item: dict) -> None:
+    """
+    Handle a queue item like the process that received it would have.
+    """
+
+    source = item["source"]
+    since = tracing.since(item["received"]) if "received" in item else None
+
+    if source == "matrix":
+        try:
+            app.handle_event(item["event"], since)
+        except Exception:
+            app.logger.exception("Failed to handle Matrix event:")
+    elif source == "discord" and since is None:
+        # Broadcasts, which are traced by the ingress process.
+        app.discord.handle_otype(item["data"], item["type"])
+    elif source == "discord":
+        with tracing.trace("discord", since=since):
+            app.discord.handle_otype(item["data"], item["type"])
+
+
+def report(traces: multiprocessing.Queue, *trace) -> None:
+    """
+    Send a finished trace to the ingress process, it's dropped instead of
+    holding up bridging if the ingress process falls behind.
+    """
+
+    try:
+        traces.put_nowait(trace)
+    except queue.Full:
+        pass
+
+
+def run_worker(
+    idx: int,
+    basedir: str,
+    config: dict,
+    worker_queue: multiprocessing.Queue,
+    traces: multiprocessing.Queue,
+    expired: threading.Event,
+) -> None:
+    # We're stopped by the ingress process, after draining our queue.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # Imported here as `main` imports us.
+    import main
+
+    app = main.setup_worker(idx, basedir, config)
+    tracing.REPORT = functools.partial(report, traces)
+    journal = Journal(f"{basedir}/journal-worker-{idx}.jsonl")
+    journaled = 0
+
+    while True:
+        item = worker_queue.get()
+
+        if item["source"] == "control":
+            if item["op"] == "stop":
+                break
+
+            if item["op"] == "rooms":
+                app.db.load_rooms()
+            elif item["op"] == "emotes":
+                for name, mxc_url in item["emotes"].items():
+                    app.m_emotes.set(name, mxc_url)
+        elif expired.is_set():
+            # We ran out of time, the rest is handled on the next start. The
+            # time spent journaled isn't part of bridging it.
+            item.pop("received", None)
+            journal.append(item)
+            journaled += 1
+        else:
+            dispatch(app, item)
+
+    flushed = app.edits.flush()
+
+    app.logger.info(
+        f"Stopped, flushed {flushed} edits and journaled {journaled} events."
+    )